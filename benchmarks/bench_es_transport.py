@@ -0,0 +1,129 @@
+"""Transfer size and latency of the film search query with the default and the tuned Elasticsearch transport.
+
+    python benchmarks/bench_es_transport.py [--host localhost:9200] [--query star] [--requests 500] [--concurrency 20]
+
+Needs a running Elasticsearch with the movies index. The "default" client is AsyncElasticsearch with library defaults
+and the full response envelope, "tuned" is configured like db.elastic.create_elastic(): larger keep-alive pool,
+gzip, timeouts and retries and filter_path. Wire bytes are measured with a separate raw HTTP request per variant,
+because the client only exposes decompressed bodies.
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import sys
+import time
+
+import aiohttp
+import orjson
+from elasticsearch import AsyncElasticsearch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from core import config  # noqa: E402
+from db.elastic import SEARCH_FILTER_PATH, KeepAliveConnection  # noqa: E402
+from services.film import FILM_SHORT_FIELDS  # noqa: E402
+
+
+def search_body(query: str) -> dict:
+    """The body FilmService.search sends."""
+    return {
+        '_source': FILM_SHORT_FIELDS,
+        'query': {
+            'multi_match': {
+                'query': query,
+                'fields': ['title', 'description', 'actors_names', 'directors_names', 'writers_names'],
+            }
+        },
+        'sort': {'imdb_rating': {'order': 'desc'}},
+    }
+
+
+def make_client(variant: str, host: str) -> AsyncElasticsearch:
+    if variant == 'default':
+        return AsyncElasticsearch(hosts=[host])
+    return AsyncElasticsearch(
+        hosts=[host],
+        connection_class=KeepAliveConnection,
+        maxsize=config.ELASTIC_MAX_CONNECTIONS,
+        http_compress=True,
+        timeout=config.ELASTIC_TIMEOUT_S,
+        max_retries=config.ELASTIC_MAX_RETRIES,
+        retry_on_timeout=config.ELASTIC_RETRY_ON_TIMEOUT,
+    )
+
+
+async def wire_bytes(variant: str, host: str, body: dict, page_size: int) -> dict:
+    params = {'size': str(page_size)}
+    headers = {'content-type': 'application/json'}
+    data = orjson.dumps(body)
+    if variant == 'tuned':
+        params['filter_path'] = SEARCH_FILTER_PATH
+        headers.update({'accept-encoding': 'gzip,deflate', 'content-encoding': 'gzip'})
+        data = gzip.compress(data)
+
+    # Иначе aiohttp сам добавит Accept-Encoding и ES сожмёт ответ и для варианта без сжатия
+    skip_auto_headers = () if variant == 'tuned' else ('Accept-Encoding',)
+    async with aiohttp.ClientSession(auto_decompress=False, skip_auto_headers=skip_auto_headers) as session:
+        url = f'http://{host}/{config.ELASTIC_MOVIES_INDEX}/_search'
+        async with session.post(url, params=params, data=data, headers=headers) as resp:
+            raw = await resp.read()
+    return {'request_bytes': len(data), 'response_bytes': len(raw)}
+
+
+async def measure(variant: str, args) -> dict:
+    client = make_client(variant, args.host)
+    body = search_body(args.query)
+    kwargs = {'filter_path': SEARCH_FILTER_PATH} if variant == 'tuned' else {}
+    latencies: list[float] = []
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await client.search(index=config.ELASTIC_MOVIES_INDEX, body=body, size=args.page_size, **kwargs)
+            latencies.append(time.perf_counter() - started)
+
+    try:
+        # Прогрев: открываем соединения до замера
+        await client.search(index=config.ELASTIC_MOVIES_INDEX, body=body, size=args.page_size, **kwargs)
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+    finally:
+        await client.close()
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3)
+
+    return {
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        **await wire_bytes(variant, args.host, body, args.page_size),
+    }
+
+
+async def run(args) -> dict:
+    return {variant: await measure(variant, args) for variant in ('default', 'tuned')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=f'{config.ELASTIC_HOST}:{config.ELASTIC_PORT}')
+    parser.add_argument('--query', default='star')
+    parser.add_argument('--page-size', type=int, default=config.PAGE_SIZE)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    print(orjson.dumps(asyncio.run(run(args)), option=orjson.OPT_INDENT_2).decode())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Per-item CPU cost of turning ES hits into an HTTP response body, before and after the no-validation fast path.
+
+    python benchmarks/bench_response_path.py [--items 100] [--repeat 200]
+
+The "validated" path reproduces what the list and person endpoints did before: build and validate
+models.film models, convert them into validated api.v1 models and let FastAPI validate and encode them
+against response_model. The "fast" path is the current one: construct() + plain dicts + orjson.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import timeit
+import uuid
+from typing import List
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+from api.v1.film import BaseFilm  # noqa: E402
+from api.v1.person import PersonSearchResult  # noqa: E402
+from models.film import Film as ServiceFilm  # noqa: E402
+from models.film import FilmShort as ServiceFilmShort  # noqa: E402
+from models.film import Person as ServicePerson  # noqa: E402
+
+
+def make_film_hit(i: int) -> dict:
+    people = [{'uid': str(uuid.uuid4()), 'name': f'Person {i}-{j}'} for j in range(6)]
+    return {
+        '_id': str(uuid.uuid4()),
+        '_source': {
+            'title': f'Film {i}',
+            'imdb_rating': 5 + i % 50 / 10,
+            'description': 'Lorem ipsum dolor sit amet. ' * 10,
+            'genres': [{'uid': str(uuid.uuid4()), 'name': 'Drama'}],
+            'actors': people[:4],
+            'writers': people[4:5],
+            'directors': people[5:],
+            'work_type': 'movie',
+            'created': '2021-07-01',
+            'actors_names': [p['name'] for p in people[:4]],
+            'writers_names': [people[4]['name']],
+            'directors_names': [people[5]['name']],
+        },
+    }
+
+
+def make_person_hit(i: int) -> dict:
+    """A hit of PersonService.search_persons: the name and the films_count script field."""
+    return {
+        '_id': str(uuid.uuid4()),
+        '_source': {'name': f'Person {i}'},
+        'fields': {'films_count': [i % 30]},
+    }
+
+
+FILMS_FIELD = create_response_field(name='response', type_=List[BaseFilm])
+PERSONS_FIELD = create_response_field(name='response', type_=List[PersonSearchResult])
+
+
+def films_validated(hits: list[dict]) -> bytes:
+    films = [ServiceFilm(uuid=h['_id'], **h['_source']) for h in hits]
+    content = [BaseFilm(uuid=f.uuid, title=f.title, imdb_rating=f.imdb_rating) for f in films]
+    content = asyncio.run(serialize_response(field=FILMS_FIELD, response_content=content))
+    return orjson.dumps(jsonable_encoder(content))
+
+
+def films_fast(hits: list[dict]) -> bytes:
+    return orjson.dumps([BaseFilm.to_response(ServiceFilmShort.from_es(h)) for h in hits])
+
+
+def persons_validated(hits: list[dict]) -> bytes:
+    persons = [ServicePerson(uuid=h['_id'], films_count=h['fields']['films_count'][0], **h['_source']) for h in hits]
+    content = [PersonSearchResult(uuid=p.uuid, full_name=p.name, films_count=p.films_count) for p in persons]
+    content = asyncio.run(serialize_response(field=PERSONS_FIELD, response_content=content))
+    return orjson.dumps(jsonable_encoder(content))
+
+
+def persons_fast(hits: list[dict]) -> bytes:
+    return orjson.dumps([PersonSearchResult.to_response(ServicePerson.from_es(h)) for h in hits])
+
+
+def measure(fn, hits: list[dict], repeat: int) -> float:
+    """Best per-item time in microseconds."""
+    timings = timeit.repeat(lambda: fn(hits), number=1, repeat=repeat)
+    return min(timings) / len(hits) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    # asyncio.run() overhead is not part of the response path, measure it separately and subtract
+    loop_overhead = min(timeit.repeat(lambda: asyncio.run(asyncio.sleep(0)), number=1, repeat=args.repeat))
+
+    results = {}
+    for name, make_hit, validated, fast in (
+            ('film_list', make_film_hit, films_validated, films_fast),
+            ('person_search', make_person_hit, persons_validated, persons_fast),
+    ):
+        hits = [make_hit(i) for i in range(args.items)]
+        assert orjson.loads(validated(hits)) == orjson.loads(fast(hits))
+        before = measure(validated, hits, args.repeat) - loop_overhead / args.items * 1e6
+        after = measure(fast, hits, args.repeat)
+        results[name] = {
+            'items': args.items,
+            'validated_us_per_item': round(before, 2),
+            'fast_us_per_item': round(after, 2),
+            'saved_us_per_item': round(before - after, 2),
+            'speedup': round(before / after, 1),
+        }
+
+    print(orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
+
+
+if __name__ == '__main__':
+    main()
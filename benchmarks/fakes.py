@@ -0,0 +1,564 @@
+"""In-memory stand-ins for Elasticsearch and Redis and a seeded synthetic catalogue.
+
+They implement only what the API uses, with a configurable simulated round-trip latency,
+and count the calls they receive so benchmarks can report backend load.
+"""
+import asyncio
+import fnmatch
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from functools import cmp_to_key
+from typing import Any, Optional, Set
+
+import orjson
+from elasticsearch import AsyncElasticsearch
+from elasticsearch import exceptions as es_exceptions
+
+from core import config
+from db.elastic import WrappedAsyncElasticsearch
+
+WORDS = (
+    'star', 'war', 'love', 'night', 'dark', 'king', 'last', 'city', 'dream', 'river', 'blood', 'ghost',
+    'summer', 'empire', 'secret', 'story', 'lost', 'black', 'wild', 'storm', 'return', 'island', 'fire',
+)
+FIRST_NAMES = ('John', 'Anna', 'George', 'Maria', 'Harrison', 'Carrie', 'Mark', 'Olga', 'Peter', 'Liv')
+LAST_NAMES = ('Lucas', 'Ford', 'Fisher', 'Hamill', 'Smith', 'Ivanova', 'Jackson', 'Tyler', 'Nolan', 'Kim')
+GENRES = ('Action', 'Adventure', 'Comedy', 'Drama', 'Fantasy', 'Horror', 'Romance', 'Sci-Fi', 'Thriller', 'Western')
+
+
+class Catalogue:
+    """Seeded synthetic films, persons and genres shaped like the documents our ETL writes."""
+
+    def __init__(self, films: int = 2000, persons: int = 500, seed: int = 42):
+        rnd = random.Random(seed)
+
+        def new_id() -> str:
+            return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+        self.genres = {genre_id: {'id': genre_id, 'name': name} for genre_id, name in ((new_id(), n) for n in GENRES)}
+        self.persons = {
+            person_id: {'id': person_id, 'name': f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}', 'filmworks': []}
+            for person_id in (new_id() for _ in range(persons))
+        }
+        genre_ids = list(self.genres)
+        person_ids = list(self.persons)
+
+        self.films = {}
+        for i in range(films):
+            film_id = new_id()
+            genres = rnd.sample(genre_ids, rnd.randint(1, 3))
+            roles = {role: rnd.sample(person_ids, count) for role, count in
+                     (('actors', 4), ('writers', 1), ('directors', 1))}
+            film = {
+                'id': film_id,
+                'title': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).capitalize() + f' {i}',
+                'imdb_rating': round(rnd.uniform(1, 10), 1),
+                'description': ' '.join(rnd.choice(WORDS) for _ in range(40)),
+                'genres': [{'uid': g, 'name': self.genres[g]['name']} for g in genres],
+                'genres_ids': genres,
+                'work_type': 'movie',
+                'created': '2021-07-01',
+            }
+            for role, ids in roles.items():
+                film[role] = [{'uid': p, 'name': self.persons[p]['name']} for p in ids]
+                film[f'{role}_names'] = [self.persons[p]['name'] for p in ids]
+                for p in ids:
+                    self.persons[p]['filmworks'].append(
+                        {'uid': film_id, 'title': film['title'], 'imdb_rating': film['imdb_rating']}
+                    )
+            self.films[film_id] = film
+
+    def indices(self) -> dict[str, dict[str, dict]]:
+        return {
+            config.ELASTIC_MOVIES_INDEX: self.films,
+            config.ELASTIC_PERSONS_INDEX: self.persons,
+            config.ELASTIC_GENRES_INDEX: self.genres,
+        }
+
+
+def _get_path(source: dict, path: str) -> list:
+    """Values of a dotted field path, lists are flattened like ES does."""
+    values = [source]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                item = value[part]
+                next_values.extend(item if isinstance(item, list) else [item])
+        values = next_values
+    return values
+
+
+def _filter_response(value: Any, paths: list[list[str]]) -> Any:
+    """Keeps only the given dotted paths like ES filter_path does, empty objects and lists are dropped."""
+    if isinstance(value, list):
+        items = [_filter_response(item, paths) for item in value]
+        return [item for item in items if item is not None] or None
+    if not isinstance(value, dict):
+        return value
+
+    result = {}
+    for key, item in value.items():
+        if any(path == [key] for path in paths):
+            result[key] = item
+            continue
+        rest = [path[1:] for path in paths if len(path) > 1 and path[0] == key]
+        if rest:
+            item = _filter_response(item, rest)
+            if item is not None:
+                result[key] = item
+    return result or None
+
+
+# Единственный вид script_fields, который использует сервис: размер массива из _source
+_SOURCE_SIZE_SCRIPT_RE = re.compile(r"params\['_source'\]\['(\w+)'\]\.size\(\)")
+
+_SECTION_RE = re.compile(r'{{#(\w+)}}(.*?){{/\1}}', re.S)
+_VARIABLE_RE = re.compile(r'{{(\w+)}}')
+
+
+def render_mustache(source: str, params: dict) -> str:
+    """The subset of ES mustache the search templates use: {{var}}, {{#section}}...{{/section}} for optional
+    parts and {{#toJson}}param{{/toJson}}."""
+    def section(match: re.Match) -> str:
+        name, inner = match.groups()
+        if name == 'toJson':
+            return orjson.dumps(params.get(inner.strip())).decode()
+        return render_mustache(inner, params) if params.get(name) else ''
+
+    source = _SECTION_RE.sub(section, source)
+    return _VARIABLE_RE.sub(lambda match: str(params.get(match.group(1), '')), source)
+
+
+def filter_path(resp: dict, path: Optional[str]) -> dict:
+    if not path:
+        return resp
+    return _filter_response(resp, [part.split('.') for part in path.split(',')]) or {}
+
+
+class InMemoryElasticsearch(AsyncElasticsearch):
+    """Replaces the transport level of AsyncElasticsearch, so WrappedAsyncElasticsearch on top of it
+    still goes through the real caching code."""
+
+    def __init__(self, indices: dict[str, dict[str, dict]], latency_s: float = 0.002, **kwargs):
+        super().__init__(hosts=['fake-elastic:9200'], **kwargs)
+        self.indices = indices
+        self.latency_s = latency_s
+        self.available = True
+        self.calls = Counter()
+        self._scrolls: dict[str, list[dict]] = {}
+        self._scripts: dict[str, str] = {}
+
+    async def _roundtrip(self, method: str) -> None:
+        self.calls[method] += 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        if not self.available:
+            raise es_exceptions.ConnectionError('N/A', 'Connection refused', ConnectionRefusedError())
+
+    def _index(self, index: str) -> dict[str, dict]:
+        if index not in self.indices:
+            raise es_exceptions.NotFoundError(404, 'index_not_found_exception', {'index': index})
+        return self.indices[index]
+
+    @staticmethod
+    def _project(source: dict, includes) -> Optional[dict]:
+        if includes is True or includes is None:
+            return source
+        if includes is False:
+            return None
+        if isinstance(includes, dict):
+            includes = includes.get('includes', ['*'])
+        if isinstance(includes, str):
+            includes = [includes]
+        top = {k: v for k, v in source.items() if any(fnmatch.fnmatch(k, p) for p in includes if '.' not in p)}
+        nested = _filter_response(source, [p.split('.') for p in includes if '.' in p]) or {}
+        return {**nested, **top}
+
+    @staticmethod
+    def _script_fields(source: dict, script_fields: dict) -> dict:
+        fields = {}
+        for name, field in script_fields.items():
+            match = _SOURCE_SIZE_SCRIPT_RE.search(field['script']['source'])
+            if match is None:
+                raise NotImplementedError(f'Fake Elasticsearch does not support script {field["script"]}')
+            fields[name] = [len(source.get(match.group(1)) or ())]
+        return fields
+
+    def _matches(self, doc_id: str, source: dict, query: dict) -> tuple[bool, float]:
+        if not query or 'match_all' in query:
+            return True, 1.0
+        if 'bool' in query:
+            clauses = query['bool']
+            score = 0.0
+            for clause in clauses.get('must', []) + clauses.get('filter', []):
+                matched, clause_score = self._matches(doc_id, source, clause)
+                if not matched:
+                    return False, 0.0
+                score += clause_score
+            should = clauses.get('should', [])
+            if should:
+                scores = [s for m, s in (self._matches(doc_id, source, c) for c in should) if m]
+                if not scores and not clauses.get('must') and not clauses.get('filter'):
+                    return False, 0.0
+                score += sum(scores)
+            return True, score or 1.0
+        if 'term' in query:
+            field, value = next(iter(query['term'].items()))
+            if isinstance(value, dict):
+                value = value['value']
+            values = [doc_id] if field == '_id' else _get_path(source, field)
+            return str(value) in [str(v) for v in values], 1.0
+        if 'terms' in query:
+            field, wanted = next(iter(query['terms'].items()))
+            values = [doc_id] if field == '_id' else _get_path(source, field)
+            return bool({str(w) for w in wanted} & {str(v) for v in values}), 1.0
+        if 'ids' in query:
+            return doc_id in query['ids']['values'], 1.0
+        if 'multi_match' in query:
+            words = query['multi_match']['query'].lower().split()
+            fields = [f.split('^')[0] for f in query['multi_match'].get('fields', ['*'])]
+            text = ' '.join(str(v) for f in fields for v in _get_path(source, f)).lower()
+            hits = sum(text.count(word) for word in words)
+            return hits > 0, float(hits)
+        if 'nested' in query:
+            return self._matches(doc_id, source, query['nested']['query'])
+        raise NotImplementedError(f'Fake Elasticsearch does not support query {query}')
+
+    @staticmethod
+    def _sort_key(hit: dict, sort: list[dict]) -> list:
+        values = []
+        for clause in sort:
+            if isinstance(clause, str):
+                field, order = clause, 'asc'
+            else:
+                field, options = next(iter(clause.items()))
+                order = options.get('order', 'asc') if isinstance(options, dict) else options
+            if field == '_score':
+                value = hit['_score']
+            elif field in ('_id', '_doc'):
+                value = hit['_id']
+            else:
+                found = _get_path(hit['_full_source'], field.removesuffix('.raw'))
+                value = found[0] if found else None
+            values.append((value, order))
+        return values
+
+    @staticmethod
+    def _compare(left: list, right: list) -> int:
+        for (a, order), (b, _) in zip(left, right):
+            if a == b:
+                continue
+            if a is None or b is None:
+                result = 1 if a is None else -1
+            else:
+                result = -1 if a < b else 1
+            return -result if order == 'desc' else result
+        return 0
+
+    def _search(self, body: Optional[dict], index: str, size: Optional[int] = None, from_: Optional[int] = None):
+        body = body or {}
+        docs = self._index(index)
+        hits = []
+        for doc_id, source in docs.items():
+            matched, score = self._matches(doc_id, source, body.get('query'))
+            if matched:
+                hits.append({'_index': index, '_type': '_doc', '_id': doc_id, '_score': score, '_full_source': source})
+
+        sort = body.get('sort') or []
+        if isinstance(sort, dict):
+            sort = [{k: v} for k, v in sort.items()]
+        if not sort:
+            sort = [{'_score': {'order': 'desc'}}, {'_id': {'order': 'asc'}}]
+        for hit in hits:
+            hit['_sort_values'] = self._sort_key(hit, sort)
+        hits.sort(key=cmp_to_key(lambda a, b: self._compare(a['_sort_values'], b['_sort_values'])))
+
+        search_after = body.get('search_after')
+        if search_after is not None and hits:
+            after = list(zip(search_after, [order for _, order in hits[0]['_sort_values']]))
+            hits = [h for h in hits if self._compare(h['_sort_values'], after) > 0]
+
+        total = len(hits)
+        size = body.get('size', size if size is not None else 10)
+        offset = body.get('from', from_ or 0)
+        page = hits[offset:offset + size]
+
+        result_hits = []
+        for hit in page:
+            item = {'_index': index, '_type': '_doc', '_id': hit['_id'], '_score': hit['_score']}
+            source = self._project(hit['_full_source'], body.get('_source', True))
+            if source is not None:
+                item['_source'] = source
+            if body.get('script_fields'):
+                item['fields'] = self._script_fields(hit['_full_source'], body['script_fields'])
+            if body.get('sort'):
+                item['sort'] = [value for value, _ in hit['_sort_values']]
+            result_hits.append(item)
+
+        resp = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': None, 'hits': result_hits},
+        }
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            resp['aggregations'] = {name: self._aggregate(hits, agg) for name, agg in aggs.items()}
+        return resp, hits
+
+    @staticmethod
+    def _aggregate(hits: list[dict], agg: dict) -> dict:
+        if 'terms' in agg:
+            counts = Counter(
+                str(value) for hit in hits for value in set(_get_path(hit['_full_source'], agg['terms']['field']))
+            )
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:agg['terms'].get('size', 10)]
+            return {'buckets': [{'key': key, 'doc_count': count} for key, count in ranked]}
+        if 'range' in agg:
+            buckets = []
+            for spec in agg['range']['ranges']:
+                low, high = spec.get('from'), spec.get('to')
+                count = sum(
+                    1 for hit in hits
+                    if any((low is None or v >= low) and (high is None or v < high)
+                           for v in _get_path(hit['_full_source'], agg['range']['field']))
+                )
+                buckets.append({**spec, 'doc_count': count})
+            return {'buckets': buckets}
+        raise NotImplementedError(f'Fake Elasticsearch does not support aggregation {agg}')
+
+    async def search(self, body=None, index=None, doc_type=None, params=None, headers=None, **kwargs):
+        await self._roundtrip('search')
+        resp, hits = self._search(body, index, kwargs.get('size'), kwargs.get('from_'))
+        if kwargs.get('scroll'):
+            scroll_id = uuid.uuid4().hex
+            size = len(resp['hits']['hits'])
+            self._scrolls[scroll_id] = [
+                {'_index': index, '_type': '_doc', '_id': h['_id'],
+                 '_source': self._project(h['_full_source'], (body or {}).get('_source', True))}
+                for h in hits[size:]
+            ]
+            resp['_scroll_id'] = scroll_id
+            resp['_page_size'] = size
+        return filter_path(resp, kwargs.get('filter_path'))
+
+    async def put_script(self, id, body, context=None, params=None, headers=None):
+        self._scripts[id] = body['script']['source']
+        return {'acknowledged': True}
+
+    async def search_template(self, body, index=None, doc_type=None, params=None, headers=None, **kwargs):
+        if body['id'] not in self._scripts:
+            raise es_exceptions.NotFoundError(404, 'resource_not_found_exception', {'id': body['id']})
+        rendered = orjson.loads(render_mustache(self._scripts[body['id']], body.get('params', {})))
+        return await InMemoryElasticsearch.search(self, body=rendered, index=index, **kwargs)
+
+    async def scroll(self, body=None, scroll_id=None, params=None, headers=None, **kwargs):
+        await self._roundtrip('scroll')
+        scroll_id = (body or {}).get('scroll_id', scroll_id)
+        remaining = self._scrolls.get(scroll_id, [])
+        size = config.ELASTIC_SCAN_PAGE_SIZE
+        page, self._scrolls[scroll_id] = remaining[:size], remaining[size:]
+        return filter_path({'_scroll_id': scroll_id, 'hits': {'hits': page}}, kwargs.get('filter_path'))
+
+    async def clear_scroll(self, body=None, scroll_id=None, params=None, headers=None, **kwargs):
+        for scroll_id in (body or {}).get('scroll_id', []):
+            self._scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    async def get(self, index, id, doc_type=None, params=None, headers=None, **kwargs):
+        await self._roundtrip('get')
+        docs = self._index(index)
+        if id not in docs:
+            raise es_exceptions.NotFoundError(404, 'not_found', {'_index': index, '_id': id, 'found': False})
+        return filter_path(
+            {
+                '_index': index, '_type': '_doc', '_id': id, '_version': 1, 'found': True,
+                '_source': self._project(docs[id], kwargs.get('_source_includes')),
+            },
+            kwargs.get('filter_path'),
+        )
+
+    async def mget(self, body=None, index=None, doc_type=None, params=None, headers=None, **kwargs):
+        await self._roundtrip('mget')
+        docs = self._index(index)
+        return filter_path({'docs': [
+            {
+                '_index': index, '_type': '_doc', '_id': doc_id, 'found': True,
+                '_source': self._project(docs[doc_id], kwargs.get('_source_includes')),
+            }
+            if doc_id in docs else {'_index': index, '_type': '_doc', '_id': doc_id, 'found': False}
+            for doc_id in body['ids']
+        ]}, kwargs.get('filter_path'))
+
+    async def close(self):
+        pass
+
+
+class FakeElasticsearch(WrappedAsyncElasticsearch, InMemoryElasticsearch):
+    pass
+
+
+class FakePipeline:
+    def __init__(self, redis: 'FakeRedis'):
+        self.redis = redis
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append((self.redis._get, key))
+
+    def set(self, key, value, **kwargs):
+        self.commands.append((lambda k, v: self.redis._set(k, v, **kwargs), key, value))
+
+    def zincrby(self, key, increment, member):
+        self.commands.append((self.redis._zincrby, key, increment, member))
+
+    async def execute(self, *, return_exceptions=False):
+        await self.redis._roundtrip('pipeline')
+        return [command(*args) for command, *args in self.commands]
+
+
+class FakeRedis:
+    """Subset of the aioredis 1.3 pool interface backed by a dict with expiry."""
+
+    def __init__(self, latency_s: float = 0.0002):
+        self.latency_s = latency_s
+        self.calls = Counter()
+        self.data: dict[str, tuple[bytes, Optional[float]]] = {}
+        self.published: list[tuple[str, bytes]] = []
+
+    async def _roundtrip(self, command: str) -> None:
+        self.calls[command] += 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _set(self, key: str, value: Any, expire: int = 0, pexpire: int = 0, exist: Optional[str] = None):
+        if exist == 'SET_IF_NOT_EXIST' and self._get(key) is not None:
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        elif isinstance(value, int):
+            value = str(value).encode()
+        timeout = expire or pexpire / 1000
+        self.data[key] = (value, time.monotonic() + timeout if timeout else None)
+        return True
+
+    async def get(self, key, *, encoding=None):
+        await self._roundtrip('get')
+        return self._get(key)
+
+    async def mget(self, key, *keys, encoding=None):
+        await self._roundtrip('mget')
+        return [self._get(k) for k in (key, *keys)]
+
+    async def set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        await self._roundtrip('set')
+        return self._set(key, value, expire, pexpire, exist)
+
+    async def incr(self, key):
+        await self._roundtrip('incr')
+        value = int(self._get(key) or 0) + 1
+        self._set(key, value)
+        return value
+
+    async def delete(self, key, *keys):
+        await self._roundtrip('delete')
+        return sum(self.data.pop(k, None) is not None for k in (key, *keys))
+
+    def _zset(self, key: str) -> dict[str, float]:
+        item = self.data.get(key)
+        if item is None:
+            item = self.data[key] = ({}, None)
+        return item[0]
+
+    def _zincrby(self, key: str, increment: float, member: str) -> float:
+        zset = self._zset(key)
+        zset[member] = zset.get(member, 0) + increment
+        return zset[member]
+
+    def _zrevranked(self, key: str) -> list[str]:
+        zset = self._zset(key)
+        return sorted(zset, key=lambda member: (-zset[member], member))
+
+    async def zincrby(self, key, increment, member):
+        await self._roundtrip('zincrby')
+        return self._zincrby(key, increment, member)
+
+    async def zrevrange(self, key, start, stop, withscores=False, encoding=None):
+        await self._roundtrip('zrevrange')
+        members = self._zrevranked(key)[start:stop + 1 if stop != -1 else None]
+        return members if encoding else [member.encode() for member in members]
+
+    async def zunionstore(self, destkey, key, *keys, with_weights=False, aggregate=None):
+        # Приложение пересчитывает рейтинг сам в себя с весом, этого и достаточно
+        await self._roundtrip('zunionstore')
+        source, weight = key if with_weights else (key, 1)
+        zset = self._zset(source)
+        self.data[destkey] = ({member: score * weight for member, score in zset.items()}, None)
+        return len(zset)
+
+    async def zremrangebyrank(self, key, start, stop):
+        await self._roundtrip('zremrangebyrank')
+        ranked = self._zrevranked(key)[::-1]
+        removed = ranked[start:stop + 1 if stop != -1 else None]
+        zset = self._zset(key)
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    def _members(self, key: str) -> Set[str]:  # set() здесь - метод класса
+        item = self.data.get(key)
+        if item is None:
+            item = self.data[key] = (set(), None)
+        return item[0]
+
+    async def sadd(self, key, member, *members):
+        await self._roundtrip('sadd')
+        added = {m.decode() if isinstance(m, bytes) else m for m in (member, *members)} - self._members(key)
+        self._members(key).update(added)
+        return len(added)
+
+    async def smembers(self, key, *, encoding=None):
+        await self._roundtrip('smembers')
+        members = sorted(self._members(key))
+        return members if encoding else [member.encode() for member in members]
+
+    async def publish(self, channel, message):
+        # Подписчиков нет: нагрузочный тест вызывает обработчик сообщений напрямую
+        await self._roundtrip('publish')
+        self.published.append((channel, message))
+        return 0
+
+    async def eval(self, script, keys=(), args=()):
+        # Единственный скрипт в приложении - снятие блокировки, если она всё ещё наша
+        await self._roundtrip('eval')
+        value = self._get(keys[0])
+        if value is not None and value == str(args[0]).encode():
+            del self.data[keys[0]]
+            return 1
+        return 0
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def flushall(self):
+        self.data.clear()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
@@ -0,0 +1,325 @@
+"""Offline load test of every /api/v1 route against in-memory Elasticsearch and Redis stand-ins.
+
+    python benchmarks/load_test.py [--requests 200] [--concurrency 20] [--output results.json]
+    python benchmarks/load_test.py --baseline results.json --tolerance 0.2
+
+For each route four scenarios are measured:
+
+* cold - every request starts with empty caches, requests go one by one;
+* warm - caches are primed, requests go with the given concurrency;
+* stampede - caches are emptied and `concurrency` identical requests arrive at once;
+* outage - caches are emptied and Elasticsearch refuses connections, shows how fast requests are rejected
+  with 503 once the circuit breaker opens (every request that needs ES counts as an error).
+
+Results are printed (or written to --output) as JSON: throughput, latency percentiles in milliseconds and the number
+of calls that reached the ES and Redis stand-ins. With --baseline the run exits with code 1 if the p95 latency of any
+route and scenario grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import os
+import platform
+import random
+import sys
+import time
+from typing import Optional
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from fastapi.routing import APIRoute  # noqa: E402
+
+import main  # noqa: E402
+from db.redis import RedisCache  # noqa: E402
+from fakes import Catalogue, FakeElasticsearch, FakeRedis  # noqa: E402
+from services import film as film_services  # noqa: E402
+from services.genre import GenreCatalogue  # noqa: E402
+from services.state import AppState  # noqa: E402
+from services.suggest import FilmSuggestIndex, PersonSuggestIndex  # noqa: E402
+from services.warmup import CacheWarmer  # noqa: E402
+
+SCENARIOS = ('cold', 'warm', 'stampede', 'outage')
+
+
+class Environment:
+    """Wires the fakes into the app the same way main.startup wires the real clients."""
+
+    def __init__(self, catalogue: Catalogue, es_latency_s: float, redis_latency_s: float):
+        self.catalogue = catalogue
+        self.redis = FakeRedis(latency_s=redis_latency_s)
+        self.cache = RedisCache(self.redis)
+        self.es = FakeElasticsearch(catalogue.indices(), latency_s=es_latency_s, cache=self.cache)
+        self.state: Optional[AppState] = None
+
+    async def start(self) -> None:
+        await self.es.put_search_templates(film_services.SEARCH_TEMPLATES)
+        self.state = AppState(
+            self.cache, self.es, GenreCatalogue(self.es), FilmSuggestIndex(self.es), PersonSuggestIndex(self.es),
+        )
+        await self.state.load()
+        # Запросы считаются, как в main.startup, но фоновые задачи не запускаются, чтобы не мешать замерам
+        self.state.warmer = CacheWarmer(main.app, self.redis, self.state.genre_catalogue)
+        main.app.state.services = self.state
+
+    async def stop(self) -> None:
+        await self.cache.drain()
+
+    async def flush(self) -> None:
+        await self.cache.drain()
+        self.redis.flushall()
+        self.cache.local.clear()
+
+    def set_es_available(self, available: bool) -> None:
+        self.es.available = available
+        if available:
+            # Не ждём пробного запроса: следующий сценарий должен начинаться с закрытым breaker
+            self.es.breaker.success()
+
+    def backend_calls(self) -> tuple[int, int]:
+        return sum(self.es.calls.values()), sum(self.redis.calls.values())
+
+
+async def request(app, path: str, query: str = '') -> tuple[int, int]:
+    """Sends one GET straight to the ASGI app, returns the status and the body size."""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'benchmark')],
+        'client': ('127.0.0.1', 50000),
+        'server': ('benchmark', 80),
+    }
+    received = False
+    status = 0
+    size = 0
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status, size
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            size += len(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, size
+
+
+def route_samples(catalogue: Catalogue, seed: int) -> dict[str, list[tuple[str, str]]]:
+    """Representative requests for every route template."""
+    rnd = random.Random(seed)
+    films = rnd.sample(list(catalogue.films), 20)
+    persons = rnd.sample(list(catalogue.persons), 20)
+    genres = list(catalogue.genres)
+    person_name = catalogue.persons[persons[0]]['name'].split()[-1]
+
+    def ids(values: list[str]) -> str:
+        return '&'.join(f'id={value}' for value in values)
+
+    return {
+        '/api/v1/film/': [
+            ('/api/v1/film/', ''),
+            ('/api/v1/film/', 'sort=-imdb_rating'),
+            ('/api/v1/film/', f'sort=title&filter[genre]={genres[0]}'),
+            ('/api/v1/film/', 'page[number]=3&page[size]=50'),
+        ],
+        '/api/v1/film/export': [('/api/v1/film/export', '')],
+        '/api/v1/film/facets': [
+            ('/api/v1/film/facets', ''),
+            ('/api/v1/film/facets', f'filter[genre]={genres[1]}'),
+        ],
+        '/api/v1/film/search': [
+            ('/api/v1/film/search', 'query=star'),
+            ('/api/v1/film/search', 'query=dark+night&page[size]=50'),
+        ],
+        '/api/v1/film/suggest': [
+            ('/api/v1/film/suggest', 'query=s'),
+            ('/api/v1/film/suggest', 'query=dark+ni'),
+            ('/api/v1/film/suggest', 'query=sta&limit=5'),
+        ],
+        '/api/v1/film/batch': [('/api/v1/film/batch', ids(films[:10]))],
+        '/api/v1/film/{uuid}': [(f'/api/v1/film/{film_id}', '') for film_id in films[:5]],
+        '/api/v1/genre/': [('/api/v1/genre/', '')],
+        '/api/v1/genre/batch': [('/api/v1/genre/batch', ids(genres[:5]))],
+        '/api/v1/genre/{uuid}': [(f'/api/v1/genre/{genre_id}', '') for genre_id in genres[:5]],
+        '/api/v1/person/export': [('/api/v1/person/export', '')],
+        '/api/v1/person/search': [('/api/v1/person/search', f'query={person_name}')],
+        '/api/v1/person/suggest': [
+            ('/api/v1/person/suggest', f'query={person_name[:2]}'),
+            ('/api/v1/person/suggest', f'query={person_name[:4]}'),
+        ],
+        '/api/v1/person/batch': [('/api/v1/person/batch', ids(persons[:10]))],
+        '/api/v1/person/{uuid}': [(f'/api/v1/person/{person_id}', '') for person_id in persons[:5]],
+        '/api/v1/person/{uuid}/film': [(f'/api/v1/person/{person_id}/film', '') for person_id in persons[:5]],
+    }
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int, calls: tuple[int, int], sizes: list[int]) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'response_bytes': round(sum(sizes) / len(sizes)),
+        'es_calls': calls[0],
+        'redis_calls': calls[1],
+    }
+
+
+async def timed(app, path: str, query: str, latencies: list[float], sizes: list[int]) -> bool:
+    started = time.perf_counter()
+    status, size = await request(app, path, query)
+    latencies.append(time.perf_counter() - started)
+    sizes.append(size)
+    return 200 <= status < 300
+
+
+async def run_scenario(env: Environment, scenario: str, samples: list[tuple[str, str]], args) -> dict:
+    app = main.app
+    latencies: list[float] = []
+    sizes: list[int] = []
+    errors = 0
+
+    await env.flush()
+    if scenario == 'outage':
+        env.set_es_available(False)
+    if scenario == 'warm':
+        for path, query in samples:
+            await request(app, path, query)
+        await env.cache.drain()
+
+    es_before, redis_before = env.backend_calls()
+    started = time.perf_counter()
+
+    if scenario == 'cold':
+        for i in range(args.requests):
+            await env.flush()
+            path, query = samples[i % len(samples)]
+            errors += not await timed(app, path, query, latencies, sizes)
+
+    elif scenario == 'warm':
+        queue = [samples[i % len(samples)] for i in range(args.requests)]
+
+        async def worker():
+            nonlocal errors
+            while queue:
+                path, query = queue.pop()
+                errors += not await timed(app, path, query, latencies, sizes)
+
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+    elif scenario == 'outage':
+        for i in range(args.requests):
+            path, query = samples[i % len(samples)]
+            errors += not await timed(app, path, query, latencies, sizes)
+        env.set_es_available(True)
+
+    elif scenario == 'stampede':
+        rounds = max(1, args.requests // args.concurrency)
+        for i in range(rounds):
+            await env.flush()
+            path, query = samples[i % len(samples)]
+            results = await asyncio.gather(*[
+                timed(app, path, query, latencies, sizes) for _ in range(args.concurrency)
+            ])
+            errors += results.count(False)
+
+    elapsed = time.perf_counter() - started
+    await env.cache.drain()
+    es_after, redis_after = env.backend_calls()
+    return summarize(latencies, elapsed, errors, (es_after - es_before, redis_after - redis_before), sizes)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for route, scenarios in results['routes'].items():
+        for scenario, stats in scenarios.items():
+            before = baseline.get('routes', {}).get(route, {}).get(scenario)
+            if before and stats['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f'{route} [{scenario}] p95 {before["p95_ms"]} ms -> {stats["p95_ms"]} ms')
+    return regressions
+
+
+async def run(args) -> dict:
+    catalogue = Catalogue(films=args.films, persons=args.persons, seed=args.seed)
+    env = Environment(catalogue, args.es_latency_ms / 1000, args.redis_latency_ms / 1000)
+    await env.start()
+
+    samples = route_samples(catalogue, args.seed)
+    routes = sorted(r.path for r in main.app.routes if isinstance(r, APIRoute) and r.path.startswith('/api/v1/'))
+    selected = [route for route in routes if route in samples and (not args.route or route in args.route)]
+
+    results = {'routes': {}}
+    for route in selected:
+        results['routes'][route] = {
+            scenario: await run_scenario(env, scenario, samples[route], args) for scenario in args.scenario
+        }
+    await env.stop()
+
+    results['uncovered_routes'] = [route for route in routes if route not in samples]
+    results['meta'] = {
+        'python': platform.python_version(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        **{name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+    }
+    return results
+
+
+def main_cli(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, default=2000)
+    parser.add_argument('--persons', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and scenario')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--es-latency-ms', type=float, default=2.0, help='simulated ES round trip')
+    parser.add_argument('--redis-latency-ms', type=float, default=0.2, help='simulated Redis round trip')
+    parser.add_argument('--route', action='append', help='run only these route templates')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare p95 latency with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative p95 growth')
+    args = parser.parse_args(argv)
+    args.scenario = args.scenario or list(SCENARIOS)
+
+    results = asyncio.run(run(args))
+    payload = orjson.dumps(results, option=orjson.OPT_INDENT_2)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(payload)
+    else:
+        print(payload.decode())
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            regressions = compare(results, orjson.loads(f.read()), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
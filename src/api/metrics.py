@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from core import metrics
+from db.cache import get_cache_stats
+from db.elastic import WrappedAsyncElasticsearch
+from services.state import get_app_state
+
+router = APIRouter()
+
+
+def _render_cache_stats() -> str:
+    lines = []
+    for tier, stats in get_cache_stats().items():
+        for name, value in stats.items():
+            lines.append(f'cache_stats{{tier="{tier}",stat="{name}"}} {value}')
+    return '# TYPE cache_stats gauge\n' + '\n'.join(lines) + '\n'
+
+
+def _render_es_protection(elastic: WrappedAsyncElasticsearch) -> str:
+    gauges = {
+        'es_concurrency_limit': elastic.limiter.limit,
+        'es_in_flight': elastic.limiter.in_flight,
+        'es_queued': elastic.limiter.queued,
+        'es_breaker_open': int(elastic.breaker.is_open),
+    }
+    return ''.join(f'# TYPE {name} gauge\n{name} {value}\n' for name, value in gauges.items())
+
+
+@router.get('/metrics', include_in_schema=False)
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(
+        metrics.registry.render() + _render_cache_stats() + _render_es_protection(get_app_state(request).elastic),
+        media_type='text/plain; version=0.0.4',
+    )
@@ -0,0 +1,212 @@
+import re
+import time
+from hashlib import sha1
+from typing import Optional
+
+import orjson
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from core import config, metrics
+from core.limiter import Priority, set_priority
+from db.cache import cache_bypassed, response_stats
+from services.state import get_app_state
+
+# Запись кеша: 40 байт ETag, JSON с сохраняемыми заголовками, перевод строки и тело ответа
+ETAG_LENGTH = 40
+
+# Индексы, от данных которых зависят ответы маршрутов, их поколения входят в ключ кеша. Проверяются по порядку,
+# выигрывает первое совпадение: фильмография персоны собирается из документов фильмов, а список фильмов и фасеты
+# берут жанры из каталога жанров
+_ROUTE_INDICES = [
+    (re.compile(r'/api/v1/person/[^/]+/film$'), (config.ELASTIC_PERSONS_INDEX, config.ELASTIC_MOVIES_INDEX)),
+    (re.compile(r'/api/v1/film(/facets)?$'), (config.ELASTIC_MOVIES_INDEX, config.ELASTIC_GENRES_INDEX)),
+    (re.compile(r'/api/v1/film(/|$)'), (config.ELASTIC_MOVIES_INDEX,)),
+    (re.compile(r'/api/v1/genre(/|$)'), (config.ELASTIC_GENRES_INDEX,)),
+    (re.compile(r'/api/v1/person(/|$)'), (config.ELASTIC_PERSONS_INDEX,)),
+]
+
+# Значения по умолчанию не влияют на ответ, поэтому в ключ кеша не попадают
+_DEFAULT_PARAMS = {
+    'page[number]': '1',
+}
+
+_ROUTE_PRIORITIES = {route: Priority[name.upper()] for route, name in config.ROUTE_PRIORITIES.items()}
+
+
+class PriorityMiddleware:
+    """Sets the priority of the ES calls of a request from ROUTE_PRIORITIES. A plain ASGI middleware, so that
+    the context variable is set before the other middlewares copy the context into their tasks."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http':
+            priority = _ROUTE_PRIORITIES.get(metrics.route_label(scope).rstrip('/'))
+            if priority is not None:
+                set_priority(priority)
+        await self.app(scope, receive, send)
+
+
+class HTTPMiddleware(BaseHTTPMiddleware):
+    """BaseHTTPMiddleware that passes streaming routes straight to the app. call_next() of Starlette collects
+    the response body in an unbounded queue, which would buffer a whole export in memory and ignore backpressure."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'].rstrip('/') in config.STREAMING_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+def _normalize_params(request: Request) -> list[tuple[str, str]]:
+    params = []
+    for name in config.RESPONSE_CACHE_PARAMS:
+        values = request.query_params.getlist(name)
+        if not values:
+            continue
+        value = ','.join(' '.join(value.split()) for value in values)
+        if name == 'filter[genre]':
+            value = value.lower()
+        if value == _DEFAULT_PARAMS.get(name) or (name == 'page[size]' and value == str(config.PAGE_SIZE)):
+            continue
+        params.append((name, value))
+    return params
+
+
+async def response_cache_key(request: Request, params: list[tuple[str, str]]) -> str:
+    path = request.url.path.rstrip('/') or '/'
+    cache = get_app_state(request).cache
+    generations = []
+    for pattern, indices in _ROUTE_INDICES:
+        if pattern.match(path):
+            # Ответ может зависеть от любого документа индекса, поэтому в ключ входит и поколение страниц
+            generations = [
+                f'{index}:{await cache.get_generation(index)}.{await cache.get_pages_generation(index)}'
+                for index in indices
+            ]
+            break
+    raw = f'{path}?{"&".join(f"{name}={value}" for name, value in params)}'
+    return f'response:{",".join(generations)}:{sha1(raw.encode()).hexdigest()}'
+
+
+def _etag_matches(request: Request, etag: bytes) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"').encode() == etag:
+            return True
+    return False
+
+
+def _build_response(request: Request, entry: bytes, cache_status: str) -> Response:
+    etag = entry[:ETAG_LENGTH]
+    saved_headers, body = entry[ETAG_LENGTH:].split(b'\n', 1)
+    headers = orjson.loads(saved_headers)
+    headers.update({'ETag': f'"{etag.decode()}"', 'X-Cache': cache_status})
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+def _excluded(path: str) -> bool:
+    path = path.rstrip('/')
+    return any(path == prefix or path.startswith(prefix + '/') for prefix in config.RESPONSE_CACHE_EXCLUDE)
+
+
+async def _render(
+        request: Request, call_next: RequestResponseEndpoint, key: str
+) -> tuple[Optional[bytes], Optional[Response]]:
+    response = await call_next(request)
+    body = b''.join([chunk async for chunk in response.body_iterator])
+    if response.status_code != 200:
+        return None, Response(
+            content=body,
+            status_code=response.status_code,
+            headers={k: v for k, v in response.headers.items() if k != 'content-length'},
+        )
+
+    saved_headers = {name: response.headers[name] for name in config.RESPONSE_CACHE_HEADERS if name in response.headers}
+    entry = sha1(body).hexdigest().encode() + orjson.dumps(saved_headers) + b'\n' + body
+    cache = get_app_state(request).cache
+    cache.pipeline.set(key, entry, expire=config.REDIS_CACHE_EXPIRE_S)
+    cache.local.set(key, entry, len(entry))
+    return entry, None
+
+
+async def response_cache_middleware(request: Request, call_next: RequestResponseEndpoint) -> Response:
+    if (
+            not config.RESPONSE_CACHE_ENABLED
+            or request.method != 'GET'
+            or not request.url.path.startswith(config.RESPONSE_CACHE_PREFIX)
+            or _excluded(request.url.path)
+    ):
+        return await call_next(request)
+
+    params = _normalize_params(request)
+    cache = get_app_state(request).cache
+    bypassed = cache_bypassed()
+    entry = None
+    with metrics.timer('cache'):
+        key = await response_cache_key(request, params)
+        if not bypassed:
+            entry = cache.local.get(key)
+            if entry is None:
+                entry = await cache.pipeline.get(key)
+                if entry:
+                    cache.local.set(key, entry, len(entry))
+    if not bypassed:
+        metrics.registry.inc(
+            'cache_lookups_total', index='_response', tier='response', result='hit' if entry else 'miss',
+        )
+
+    if entry:
+        response_stats.hits += 1
+        _record_request(request, params)
+        return _build_response(request, entry, 'HIT')
+
+    response_stats.misses += 1
+    entry, error_response = await cache.single_flight(key, lambda: _render(request, call_next, key))
+    if entry is None:
+        return error_response
+    if not bypassed:
+        _record_request(request, params)
+    return _build_response(request, entry, 'MISS')
+
+
+def _record_request(request: Request, params: list[tuple[str, str]]) -> None:
+    """Counts a successful request for the cache warm-up, replays of the warm-up itself are not counted."""
+    warmer = get_app_state(request).warmer
+    if warmer is not None:
+        warmer.record(request.url.path, params)
+
+
+async def metrics_middleware(request: Request, call_next: RequestResponseEndpoint) -> Response:
+    """Outermost middleware: collects the timings recorded by the cache, ES and API layers during the request
+    into per-route histograms and reports them to the client in the Server-Timing header."""
+    started = time.perf_counter()
+    timings = metrics.start_request()
+    response = await call_next(request)
+    total = time.perf_counter() - started
+
+    route = metrics.route_label(request.scope)
+    metrics.registry.observe('http_request_seconds', total, route=route, status=response.status_code)
+    for name in ('cache', 'es', 'es_took', 'model'):
+        if name in timings:
+            metrics.registry.observe(f'http_{name}_seconds', timings[name], route=route)
+    if 'content-length' in response.headers:
+        metrics.registry.observe(
+            'http_response_bytes', int(response.headers['content-length']), metrics.BYTES_BUCKETS, route=route,
+        )
+
+    response.headers['Server-Timing'] = metrics.server_timing({**timings, 'total': total})
+    return response
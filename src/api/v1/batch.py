@@ -0,0 +1,18 @@
+from http import HTTPStatus
+from typing import List
+from uuid import UUID
+
+from fastapi import HTTPException, Query
+
+from core import config
+
+
+def get_batch_ids(
+        ids: List[UUID] = Query(..., alias='id', description=f'Repeated id param, up to {config.BATCH_MAX_IDS} ids'),
+) -> List[UUID]:
+    if len(ids) > config.BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail=f'too many ids, at most {config.BATCH_MAX_IDS} are allowed',
+        )
+    return ids
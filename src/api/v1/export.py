@@ -0,0 +1,61 @@
+from typing import Any, AsyncGenerator, AsyncIterator, Callable
+
+import orjson
+from fastapi.responses import StreamingResponse
+from starlette.types import Send
+
+from core import config
+
+
+class NDJSONResponse(StreamingResponse):
+    """Streams an async generator of NDJSON chunks. The next chunk is produced only after the server has accepted
+    the previous one, so memory stays bounded by one scroll page and one chunk. When the client disconnects
+    Starlette cancels the streaming task, the generator is then closed within that task so that the ES scroll
+    is cleared."""
+
+    media_type = 'application/x-ndjson'
+
+    async def stream_response(self, send: Send) -> None:
+        # Starlette отменяет задачу потока, но не дожидается её: закрыть генератор снаружи, пока он ещё
+        # выполняется, нельзя, поэтому он закрывается здесь же, после того как отмена до него дошла
+        try:
+            await super().stream_response(send)
+        finally:
+            await self.body_iterator.aclose()
+
+
+async def _chain(first: list, items: AsyncGenerator) -> AsyncIterator:
+    for item in first:
+        yield item
+    async for item in items:
+        yield item
+
+
+async def _ndjson_chunks(
+        first: list, items: AsyncGenerator, to_response: Callable[[Any], dict]
+) -> AsyncIterator[bytes]:
+    chunk = bytearray()
+    try:
+        async for item in _chain(first, items):
+            chunk += orjson.dumps(to_response(item))
+            chunk += b'\n'
+            if len(chunk) >= config.EXPORT_CHUNK_BYTES:
+                yield bytes(chunk)
+                chunk.clear()
+        if chunk:
+            yield bytes(chunk)
+    finally:
+        await items.aclose()
+
+
+async def ndjson_response(items: AsyncGenerator, to_response: Callable[[Any], dict]) -> NDJSONResponse:
+    """Items as NDJSON lines in chunks of about EXPORT_CHUNK_BYTES. The first item is read before the response
+    starts, so that an overloaded or unavailable ES is answered with 503 instead of a broken stream."""
+    try:
+        first = [await items.__anext__()]
+    except StopAsyncIteration:
+        first = []
+    except BaseException:
+        await items.aclose()
+        raise
+    return NDJSONResponse(_ndjson_chunks(first, items, to_response))
@@ -1,18 +1,28 @@
 import typing
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-from core import config
+from api.v1.batch import get_batch_ids
+from api.v1.export import NDJSONResponse, ndjson_response
+from api.v1.pagination import NEXT_CURSOR_HEADER, TOTAL_COUNT_HEADER, get_cursor
+from core import config, metrics
 from core.exceptions import NotFoundError
 from models.film import Film as ServiceFilm
+from models.film import FilmFacets as ServiceFilmFacets
+from models.film import FilmShort as ServiceFilmShort
 from services.film import FilmService, get_film_service
+from services.pagination import InvalidCursorError
 
 router = APIRouter()
 
+# Данные из ES уже проверены при индексации, поэтому ручки собирают ответ из словарей и возвращают
+# ORJSONResponse напрямую, минуя повторную валидацию по response_model. Модели ниже описывают схему ответа.
+
 
 class BaseFilm(BaseModel):
     uuid: UUID
@@ -20,13 +30,12 @@ class BaseFilm(BaseModel):
     imdb_rating: float
 
     @staticmethod
-    def from_service_model(other: ServiceFilm):
-        film = BaseFilm(
-            uuid=other.uuid,
-            title=other.title,
-            imdb_rating=other.imdb_rating,
-        )
-        return film
+    def to_response(other: ServiceFilmShort) -> dict:
+        return {
+            'uuid': other.uuid,
+            'title': other.title,
+            'imdb_rating': other.imdb_rating,
+        }
 
 
 class PersonShort(BaseModel):
@@ -47,18 +56,43 @@ class Film(BaseFilm):
     directors: List[PersonShort]
 
     @staticmethod
-    def from_service_model(other: ServiceFilm):
-        film = Film(
-            uuid=other.uuid,
-            title=other.title,
-            imdb_rating=other.imdb_rating,
-            description=other.description,
-            genres=other.genres,
-            actors=other.actors,
-            writers=other.writers,
-            directors=other.directors
-        )
-        return film
+    def to_response(other: ServiceFilm) -> dict:
+        return {
+            'uuid': other.uuid,
+            'title': other.title,
+            'imdb_rating': other.imdb_rating,
+            'description': other.description,
+            'genres': [{'uid': g.uid, 'name': g.name} for g in other.genres],
+            'actors': [{'uid': p.uid, 'name': p.name} for p in other.actors],
+            'writers': [{'uid': p.uid, 'name': p.name} for p in other.writers],
+            'directors': [{'uid': p.uid, 'name': p.name} for p in other.directors],
+        }
+
+
+class GenreFacet(BaseModel):
+    uuid: UUID
+    name: Optional[str]
+    count: int
+
+
+class RatingFacet(BaseModel):
+    min: Optional[float]
+    max: Optional[float]
+    count: int
+
+
+class FilmFacets(BaseModel):
+    total: int
+    genres: List[GenreFacet]
+    imdb_rating: List[RatingFacet]
+
+    @staticmethod
+    def to_response(other: ServiceFilmFacets) -> dict:
+        return {
+            'total': other.total,
+            'genres': [{'uuid': g.uuid, 'name': g.name, 'count': g.count} for g in other.genres],
+            'imdb_rating': [{'min': r.min, 'max': r.max, 'count': r.count} for r in other.imdb_rating],
+        }
 
 
 @router.get('/search', response_model=List[BaseFilm])
@@ -67,7 +101,7 @@ async def film_search_list(
         page_number: typing.Optional[int] = Query(1, alias='page[number]', ge=1),
         page_size: typing.Optional[int] = Query(config.PAGE_SIZE, alias='page[size]', ge=1),
         film_service: FilmService = Depends(get_film_service)
-) -> List[BaseFilm]:
+) -> ORJSONResponse:
     try:
         model_films = await film_service.search(query, page_number, page_size)
     except NotFoundError as e:
@@ -76,10 +110,8 @@ async def film_search_list(
     if model_films is None:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='filmworks not found')
 
-    if model_films:
-        return [BaseFilm(uuid=f.uuid, title=f.title, imdb_rating=f.imdb_rating) for f in model_films]
-
-    return []
+    with metrics.timer('model'):
+        return ORJSONResponse([BaseFilm.to_response(f) for f in model_films])
 
 
 @router.get('/', response_model=List[BaseFilm])
@@ -88,20 +120,72 @@ async def film_full_list(
         page_size: typing.Optional[int] = Query(config.PAGE_SIZE, alias='page[size]', ge=1),
         sort: str = Query(None, regex='^-?(?:title|imdb_rating)$'),
         genre_id: UUID = Query(None, alias='filter[genre]'),
+        cursor: typing.Optional[str] = Depends(get_cursor),
+        film_service: FilmService = Depends(get_film_service)
+) -> ORJSONResponse:
+    try:
+        page = await film_service.get_page(page_number, page_size, sort, genre_id, cursor)
+    except NotFoundError as e:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
+    except InvalidCursorError:
+        raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail='invalid page cursor')
+
+    headers = {}
+    if page.next_cursor:
+        headers[NEXT_CURSOR_HEADER] = page.next_cursor
+    if page.total is not None:
+        headers[TOTAL_COUNT_HEADER] = str(page.total)
+    with metrics.timer('model'):
+        return ORJSONResponse([BaseFilm.to_response(f) for f in page.items], headers=headers)
+
+
+@router.get('/facets', response_model=FilmFacets)
+async def film_facets(
+        genre_id: UUID = Query(None, alias='filter[genre]'),
+        film_service: FilmService = Depends(get_film_service)
+) -> ORJSONResponse:
+    try:
+        facets = await film_service.get_facets(genre_id)
+    except NotFoundError as e:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
+
+    with metrics.timer('model'):
+        return ORJSONResponse(FilmFacets.to_response(facets))
+
+
+@router.get('/suggest', response_model=List[BaseFilm])
+async def film_suggest(
+        query: str = Query(..., min_length=1),
+        limit: int = Query(config.SUGGEST_LIMIT, ge=1, le=config.SUGGEST_MAX_LIMIT),
         film_service: FilmService = Depends(get_film_service)
-) -> List[BaseFilm]:
+) -> ORJSONResponse:
+    suggestions = await film_service.suggest(query, limit)
+    with metrics.timer('model'):
+        return ORJSONResponse([{'uuid': s.uuid, 'title': s.text, 'imdb_rating': s.rating} for s in suggestions])
+
+
+@router.get('/export', response_class=NDJSONResponse)
+async def film_export(film_service: FilmService = Depends(get_film_service)) -> NDJSONResponse:
+    """The whole film catalogue as NDJSON, one film per line in the /{uuid} format."""
+    return await ndjson_response(film_service.iter_all(), Film.to_response)
+
+
+@router.get('/batch', response_model=List[Optional[Film]])
+async def film_batch(
+        ids: List[UUID] = Depends(get_batch_ids),
+        film_service: FilmService = Depends(get_film_service),
+) -> ORJSONResponse:
     try:
-        model_films = await film_service.get_page(page_number, page_size, sort, genre_id)
+        films = await film_service.get_many(ids)
     except NotFoundError as e:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
 
-    if model_films:
-        return [BaseFilm(uuid=f.uuid, title=f.title, imdb_rating=f.imdb_rating) for f in model_films]
-    return []
+    with metrics.timer('model'):
+        return ORJSONResponse([Film.to_response(film) if film else None for film in films])
 
 
 @router.get('/{uuid}', response_model=Film)
-async def film_details(uuid: str, film_service: FilmService = Depends(get_film_service)) -> Film:
+async def film_details(uuid: str, film_service: FilmService = Depends(get_film_service)) -> ORJSONResponse:
     try:
         film = await film_service.get_by_id(uuid)
     except NotFoundError as e:
@@ -109,4 +193,5 @@ async def film_details(uuid: str, film_service: FilmService = Depends(get_film_s
 
     if not film:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='filmwork not found')
-    return Film.from_service_model(film)
+    with metrics.timer('model'):
+        return ORJSONResponse(Film.to_response(film))
@@ -1,10 +1,12 @@
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 
+from api.v1.batch import get_batch_ids
+from core import metrics
 from core.exceptions import NotFoundError
 from services.genre import GenreService, get_genre_service
 
@@ -16,6 +18,20 @@ class Genre(BaseModel):
     name: str
 
 
+@router.get('/batch', response_model=List[Optional[Genre]])
+async def genre_batch(
+        ids: List[UUID] = Depends(get_batch_ids),
+        genre_service: GenreService = Depends(get_genre_service)
+) -> List[Optional[Genre]]:
+    try:
+        genres = await genre_service.get_many(ids)
+    except NotFoundError as e:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
+
+    with metrics.timer('model'):
+        return [Genre(uuid=genre.uuid, name=genre.name) if genre else None for genre in genres]
+
+
 @router.get('/{uuid}', response_model=Genre)
 async def genre_details(uuid: UUID, genre_service: GenreService = Depends(get_genre_service)) -> Genre:
     try:
@@ -25,7 +41,8 @@ async def genre_details(uuid: UUID, genre_service: GenreService = Depends(get_ge
 
     if not genre:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='genre not found')
-    return Genre(uuid=genre.uuid, name=genre.name)
+    with metrics.timer('model'):
+        return Genre(uuid=genre.uuid, name=genre.name)
 
 
 @router.get('/', response_model=List[Genre])
@@ -35,4 +52,5 @@ async def genre_list(genre_service: GenreService = Depends(get_genre_service)) -
     except NotFoundError as e:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
 
-    return [Genre(uuid=genre.uuid, name=genre.name) for genre in genres]
+    with metrics.timer('model'):
+        return [Genre(uuid=genre.uuid, name=genre.name) for genre in genres]
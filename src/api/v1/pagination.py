@@ -0,0 +1,20 @@
+import typing
+
+from fastapi import Query
+
+from services.pagination import CURSOR_START
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+TOTAL_COUNT_HEADER = 'X-Total-Count'
+
+
+def get_cursor(
+        cursor: typing.Optional[str] = Query(
+            None,
+            alias='page[cursor]',
+            description=f'"{CURSOR_START}" for the first page, then the opaque cursor from the {NEXT_CURSOR_HEADER} '
+                        f'header of the previous page, overrides page[number]. '
+                        f'A cursor of another sort order is rejected with 422',
+        ),
+) -> typing.Optional[str]:
+    return cursor or None
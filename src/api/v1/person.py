@@ -1,21 +1,29 @@
 import logging
+import typing
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-from core import config
+from api.v1.batch import get_batch_ids
+from api.v1.export import NDJSONResponse, ndjson_response
+from api.v1.pagination import NEXT_CURSOR_HEADER, TOTAL_COUNT_HEADER, get_cursor
+from core import config, metrics
 from core.exceptions import NotFoundError
 from models.film import FilmForPerson as ServiceFilmForPerson
 from models.film import Person as ServicePerson
 from services.person import PersonService, get_person_service
+from services.pagination import InvalidCursorError
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
+# Как и в api.v1.film, ответы собираются из словарей и отдаются ORJSONResponse без повторной валидации
+
 
 class FilmForPerson(BaseModel):
     uuid: UUID
@@ -23,13 +31,12 @@ class FilmForPerson(BaseModel):
     imdb_rating: float
 
     @staticmethod
-    def from_service_model(other: ServiceFilmForPerson):
-        film = FilmForPerson(
-            uuid=other.uid,
-            title=other.title,
-            imdb_rating=other.imdb_rating,
-        )
-        return film
+    def to_response(other: ServiceFilmForPerson) -> dict:
+        return {
+            'uuid': other.uid,
+            'title': other.title,
+            'imdb_rating': other.imdb_rating,
+        }
 
 
 class Person(BaseModel):
@@ -38,38 +45,90 @@ class Person(BaseModel):
     films: List[FilmForPerson]
 
     @staticmethod
-    def from_service_model(other: ServicePerson):
-        films = []
-        if other.filmworks:
-            films = [FilmForPerson.from_service_model(filmwork) for filmwork in other.filmworks]
-        person = Person(
-            uuid=other.uuid,
-            full_name=other.name,
-            films=films
-        )
-        return person
+    def to_response(other: ServicePerson) -> dict:
+        return {
+            'uuid': other.uuid,
+            'full_name': other.name,
+            'films': [FilmForPerson.to_response(filmwork) for filmwork in other.filmworks or ()],
+        }
+
+
+class PersonSearchResult(BaseModel):
+    """Person with the number of films only, so that search pages stay small, the filmography is at /{uuid}/film."""
+    uuid: UUID
+    full_name: str
+    films_count: int
+
+    @staticmethod
+    def to_response(other: ServicePerson) -> dict:
+        return {
+            'uuid': other.uuid,
+            'full_name': other.name,
+            'films_count': other.films_count,
+        }
 
 
-@router.get('/search', response_model=List[Person])
+@router.get('/search', response_model=List[PersonSearchResult])
 async def person_search_list(
         query: str = Query(..., min_length=2),
         page_number: int = Query(1, alias='page[number]', ge=1),
         page_size: int = Query(config.PAGE_SIZE, alias='page[size]', ge=1),
+        cursor: typing.Optional[str] = Depends(get_cursor),
+        person_service: PersonService = Depends(get_person_service)
+) -> ORJSONResponse:
+    try:
+        page = await person_service.search_persons(query, page_number, page_size, cursor)
+    except NotFoundError as e:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
+    except InvalidCursorError:
+        raise HTTPException(status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail='invalid page cursor')
+
+    headers = {NEXT_CURSOR_HEADER: page.next_cursor} if page.next_cursor else None
+    with metrics.timer('model'):
+        return ORJSONResponse([PersonSearchResult.to_response(person) for person in page.items], headers=headers)
+
+
+class PersonSuggestion(BaseModel):
+    uuid: UUID
+    full_name: str
+
+
+@router.get('/suggest', response_model=List[PersonSuggestion])
+async def person_suggest(
+        query: str = Query(..., min_length=1),
+        limit: int = Query(config.SUGGEST_LIMIT, ge=1, le=config.SUGGEST_MAX_LIMIT),
+        person_service: PersonService = Depends(get_person_service)
+) -> ORJSONResponse:
+    suggestions = await person_service.suggest(query, limit)
+    with metrics.timer('model'):
+        return ORJSONResponse([{'uuid': s.uuid, 'full_name': s.text} for s in suggestions])
+
+
+@router.get('/export', response_class=NDJSONResponse)
+async def person_export(person_service: PersonService = Depends(get_person_service)) -> NDJSONResponse:
+    """All persons as NDJSON, one person per line in the /{uuid} format."""
+    return await ndjson_response(person_service.iter_all(), Person.to_response)
+
+
+@router.get('/batch', response_model=List[Optional[Person]])
+async def person_batch(
+        ids: List[UUID] = Depends(get_batch_ids),
         person_service: PersonService = Depends(get_person_service)
-) -> List[Person]:
+) -> ORJSONResponse:
     try:
-        persons = await person_service.search_persons(query, page_number, page_size)
+        persons = await person_service.get_many(ids)
     except NotFoundError as e:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
 
-    return [Person.from_service_model(person) for person in persons]
+    with metrics.timer('model'):
+        return ORJSONResponse([Person.to_response(person) if person else None for person in persons])
 
 
 @router.get('/{uuid}', response_model=Person)
 async def person_details(
         uuid: UUID,
         person_service: PersonService = Depends(get_person_service)
-) -> Person:
+) -> ORJSONResponse:
     try:
         person = await person_service.get_by_id(uuid)
     except NotFoundError as e:
@@ -78,20 +137,28 @@ async def person_details(
     if not person:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='person not found')
 
-    return Person.from_service_model(person)
+    with metrics.timer('model'):
+        return ORJSONResponse(Person.to_response(person))
 
 
-@router.get('/{uuid}/film', response_model=List[FilmForPerson])
+@router.get('/{uuid}/film', response_model=List[Optional[FilmForPerson]])
 async def films_by_person(
         uuid: UUID,
+        page_number: int = Query(1, alias='page[number]', ge=1),
+        page_size: int = Query(config.PAGE_SIZE, alias='page[size]', ge=1),
         person_service: PersonService = Depends(get_person_service)
-) -> List[FilmForPerson]:
+) -> ORJSONResponse:
     try:
-        films = await person_service.get_films_for_person(uuid)
+        page = await person_service.get_films_for_person(uuid, page_number, page_size)
     except NotFoundError as e:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=e.error)
 
-    if films is None:
+    if page is None:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='person not found')
 
-    return [FilmForPerson.from_service_model(film) for film in films]
+    # Фильмы, которых нет в индексе фильмов, остаются null на своих местах, как в /batch
+    with metrics.timer('model'):
+        return ORJSONResponse(
+            [FilmForPerson.to_response(film) if film else None for film in page.items],
+            headers={TOTAL_COUNT_HEADER: str(page.total)},
+        )
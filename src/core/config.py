@@ -1,18 +1,95 @@
 import os
 from logging import config as logging_config
 
-from core.logger import LOGGING
+from core.logger import LOG_LEVEL, LOGGING, start_log_listener
 
 # Применяем настройки логирования
 logging_config.dictConfig(LOGGING)
+start_log_listener()
 
 # Название проекта. Используется в Swagger-документации
 PROJECT_NAME = os.getenv('PROJECT_NAME', 'movies')
 
+# Настройки сервера: число процессов-воркеров и журнал доступа
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', 8000))
+API_WORKERS = int(os.getenv('API_WORKERS', os.cpu_count() or 1))
+API_ACCESS_LOG = os.getenv('API_ACCESS_LOG', 'true').lower() == 'true'
+# Сколько секунд держать простаивающее keep-alive соединение
+API_KEEP_ALIVE_S = int(os.getenv('API_KEEP_ALIVE_S', 5))
+
 # Настройки Redis
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_POOL_MIN_SIZE = int(os.getenv('REDIS_POOL_MIN_SIZE', 10))
+REDIS_POOL_MAX_SIZE = int(os.getenv('REDIS_POOL_MAX_SIZE', 20))
 REDIS_CACHE_EXPIRE_S = int(os.getenv('REDIS_CACHE_EXPIRE_S', 60 * 5))
+# Сколько ещё секунд после REDIS_CACHE_EXPIRE_S отдаётся устаревшее значение, пока оно обновляется в фоне
+REDIS_CACHE_STALE_S = int(os.getenv('REDIS_CACHE_STALE_S', 60 * 5))
+# Сколько ещё хранится запись после окна устаревания: её отдают, только если ES перегружен или недоступен
+REDIS_CACHE_FALLBACK_S = int(os.getenv('REDIS_CACHE_FALLBACK_S', 60 * 60))
+# Агрегации (фасеты) меняются только вместе с данными индекса, поэтому живут до смены его поколения
+AGGREGATIONS_CACHE_EXPIRE_S = int(os.getenv('AGGREGATIONS_CACHE_EXPIRE_S', 60 * 60 * 24))
+# Коэффициент вероятностного досрочного обновления (XFetch), 0 - отключено
+REDIS_CACHE_XFETCH_BETA = float(os.getenv('REDIS_CACHE_XFETCH_BETA', 1.0))
+
+# Настройки локального (in-process) кеша, который проверяется перед Redis
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 10_000))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+LOCAL_CACHE_EXPIRE_S = min(int(os.getenv('LOCAL_CACHE_EXPIRE_S', 10)), REDIS_CACHE_EXPIRE_S)
+
+# Сжатие значений в Redis: zlib, lz4 (если установлен пакет lz4) или none
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'zlib')
+# Значения меньше этого размера хранятся без сжатия
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv('CACHE_COMPRESS_MIN_BYTES', 1024))
+
+# Как часто воркер перечитывает из Redis поколения индексов и версии документов, по которым строятся ключи кеша
+CACHE_GENERATION_REFRESH_S = float(os.getenv('CACHE_GENERATION_REFRESH_S', 1))
+# Сколько версий документов воркер держит в памяти между перечитываниями
+CACHE_DOC_VERSIONS_MAX_ENTRIES = int(os.getenv('CACHE_DOC_VERSIONS_MAX_ENTRIES', 100_000))
+
+# Инвалидация по событиям: ETL (или invalidate_cache.py) удаляет изменённые документы индекса из Redis вместе
+# со страницами поиска и списков и публикует их id в канал Redis, каждый воркер удаляет их из своего локального
+# кеша, каталога жанров и индексов подсказок. Сообщения теряются, пока воркер переподключается к каналу: после
+# переподключения он перечитывает поколения и версии документов и заново загружает каталог жанров и индексы
+# подсказок, иначе они обновились бы только через GENRE_CATALOGUE_REFRESH_S и SUGGEST_INDEX_REFRESH_S
+CACHE_INVALIDATION_ENABLED = os.getenv('CACHE_INVALIDATION_ENABLED', 'true').lower() == 'true'
+CACHE_INVALIDATION_CHANNEL = os.getenv('CACHE_INVALIDATION_CHANNEL', 'cache:invalidate')
+CACHE_INVALIDATION_RECONNECT_S = float(os.getenv('CACHE_INVALIDATION_RECONNECT_S', 1))
+
+# Кеш готовых HTTP-ответов: ключ - маршрут и нормализованные параметры запроса
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_PREFIX = '/api/v1/'
+RESPONSE_CACHE_PARAMS = ('page[number]', 'page[size]', 'page[cursor]', 'sort', 'filter[genre]', 'query', 'id')
+# Заголовки ответа, которые сохраняются в кеше вместе с телом
+RESPONSE_CACHE_HEADERS = ('x-next-cursor', 'x-total-count')
+# Потоковые маршруты выгрузки: минуют middleware кеша ответов и метрик, отдают NDJSON порциями
+# не меньше EXPORT_CHUNK_BYTES, а scroll между порциями живёт EXPORT_SCROLL_KEEP_ALIVE (медленный клиент)
+STREAMING_PATHS = ('/api/v1/film/export', '/api/v1/person/export')
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', 64 * 1024))
+EXPORT_SCROLL_KEEP_ALIVE = os.getenv('EXPORT_SCROLL_KEEP_ALIVE', '5m')
+# Маршруты, которые отвечают из памяти процесса быстрее, чем из кеша ответов, вместе со всеми путями под ними
+RESPONSE_CACHE_EXCLUDE = ('/api/v1/film/suggest', '/api/v1/person/suggest', '/api/v1/genre')
+
+# Прогрев кеша: воркеры считают самые частые запросы списка и поиска фильмов (sketch на CACHE_WARMUP_SKETCH_SIZE
+# ключей) и раз в CACHE_WARMUP_FLUSH_S добавляют счётчики в общий рейтинг в Redis. Один из воркеров повторяет
+# CACHE_WARMUP_TOP_KEYS лучших запросов при старте и каждые CACHE_WARMUP_INTERVAL_S, до истечения их TTL
+CACHE_WARMUP_ENABLED = os.getenv('CACHE_WARMUP_ENABLED', 'true').lower() == 'true'
+CACHE_WARMUP_PATHS = ('/api/v1/film/', '/api/v1/film/search')
+CACHE_WARMUP_SKETCH_SIZE = int(os.getenv('CACHE_WARMUP_SKETCH_SIZE', 1000))
+CACHE_WARMUP_TOP_KEYS = int(os.getenv('CACHE_WARMUP_TOP_KEYS', 200))
+CACHE_WARMUP_FLUSH_S = float(os.getenv('CACHE_WARMUP_FLUSH_S', 30))
+CACHE_WARMUP_INTERVAL_S = int(os.getenv('CACHE_WARMUP_INTERVAL_S', REDIS_CACHE_EXPIRE_S * 0.8))
+# Как часто проверять, не пора ли прогревать (в том числе после очистки Redis), и сколько запросов повторять сразу
+CACHE_WARMUP_CHECK_S = float(os.getenv('CACHE_WARMUP_CHECK_S', 10))
+CACHE_WARMUP_CONCURRENCY = int(os.getenv('CACHE_WARMUP_CONCURRENCY', 4))
+# При каждом прогреве рейтинг умножается на этот коэффициент, чтобы разлюбленные запросы из него уходили
+CACHE_WARMUP_DECAY = float(os.getenv('CACHE_WARMUP_DECAY', 0.5))
+
+# Межпроцессная блокировка в Redis: ключ после промаха пересчитывает только один воркер
+REDIS_CACHE_LOCK_ENABLED = os.getenv('REDIS_CACHE_LOCK_ENABLED', 'false').lower() == 'true'
+REDIS_CACHE_LOCK_TIMEOUT_S = float(os.getenv('REDIS_CACHE_LOCK_TIMEOUT_S', 5))
+REDIS_CACHE_LOCK_POLL_S = float(os.getenv('REDIS_CACHE_LOCK_POLL_S', 0.05))
 
 # Настройки Elasticsearch
 ELASTIC_HOST = os.getenv('ELASTIC_HOST', 'elastic')
@@ -20,8 +97,66 @@ ELASTIC_PORT = int(os.getenv('ELASTIC_PORT', 9200))
 ELASTIC_MOVIES_INDEX = os.getenv('ELASTIC_MOVIES_INDEX', 'movies')
 ELASTIC_PERSONS_INDEX = os.getenv('ELASTIC_PERSONS_INDEX', 'persons')
 ELASTIC_GENRES_INDEX = os.getenv('ELASTIC_GENRES_INDEX', 'genres')
+# Уникальное поле для досортировки при курсорной пагинации (search_after): keyword с doc_values.
+# _id не подходит: сортировка по нему грузит fielddata в heap ES
+ELASTIC_TIEBREAKER_FIELD = os.getenv('ELASTIC_TIEBREAKER_FIELD', 'id')
+# Полный обход индексов (scroll): размер страницы и время жизни контекста
+ELASTIC_SCAN_PAGE_SIZE = int(os.getenv('ELASTIC_SCAN_PAGE_SIZE', 1000))
+ELASTIC_SCROLL_KEEP_ALIVE = os.getenv('ELASTIC_SCROLL_KEEP_ALIVE', '1m')
+# Транспорт клиента ES: размер пула соединений на воркер, время жизни простаивающего соединения,
+# gzip запросов и ответов, таймаут запроса и число повторов на другом узле
+ELASTIC_MAX_CONNECTIONS = int(os.getenv('ELASTIC_MAX_CONNECTIONS', 50))
+ELASTIC_KEEP_ALIVE_S = float(os.getenv('ELASTIC_KEEP_ALIVE_S', 60))
+ELASTIC_HTTP_COMPRESS = os.getenv('ELASTIC_HTTP_COMPRESS', 'true').lower() == 'true'
+ELASTIC_TIMEOUT_S = float(os.getenv('ELASTIC_TIMEOUT_S', 5))
+ELASTIC_MAX_RETRIES = int(os.getenv('ELASTIC_MAX_RETRIES', 2))
+ELASTIC_RETRY_ON_TIMEOUT = os.getenv('ELASTIC_RETRY_ON_TIMEOUT', 'true').lower() == 'true'
+# Запрашивать у ES только те поля ответа, которые читают сервисы (filter_path)
+ELASTIC_FILTER_PATH_ENABLED = os.getenv('ELASTIC_FILTER_PATH_ENABLED', 'true').lower() == 'true'
+
+# Адаптивный (AIMD) лимит одновременных запросов к ES на воркер: растёт, пока запросы укладываются
+# в целевую задержку, и уменьшается в ELASTIC_LIMITER_BACKOFF раз, когда ES отвечает медленнее или с ошибкой
+ELASTIC_LIMITER_INITIAL = int(os.getenv('ELASTIC_LIMITER_INITIAL', 20))
+ELASTIC_LIMITER_MIN = int(os.getenv('ELASTIC_LIMITER_MIN', 2))
+ELASTIC_LIMITER_MAX = int(os.getenv('ELASTIC_LIMITER_MAX', ELASTIC_MAX_CONNECTIONS))
+ELASTIC_LIMITER_LATENCY_TARGET_S = float(os.getenv('ELASTIC_LIMITER_LATENCY_TARGET_S', 0.25))
+ELASTIC_LIMITER_BACKOFF = float(os.getenv('ELASTIC_LIMITER_BACKOFF', 0.9))
+# Запросы сверх лимита ждут в очереди, при её заполнении или по таймауту ожидания клиент получает 503
+ELASTIC_LIMITER_QUEUE_SIZE = int(os.getenv('ELASTIC_LIMITER_QUEUE_SIZE', 100))
+ELASTIC_LIMITER_QUEUE_TIMEOUT_S = float(os.getenv('ELASTIC_LIMITER_QUEUE_TIMEOUT_S', 1))
+ELASTIC_LIMITER_RETRY_AFTER_S = float(os.getenv('ELASTIC_LIMITER_RETRY_AFTER_S', 1))
+# Circuit breaker: после стольких ошибок подряд запросы к ES сразу завершаются 503, через
+# ELASTIC_BREAKER_RESET_S пропускается один пробный запрос
+ELASTIC_BREAKER_FAILURES = int(os.getenv('ELASTIC_BREAKER_FAILURES', 5))
+ELASTIC_BREAKER_RESET_S = float(os.getenv('ELASTIC_BREAKER_RESET_S', 5))
+# Приоритет запросов маршрута к ES, остальные маршруты - normal. При перегрузке первыми отбрасываются low
+ROUTE_PRIORITIES = {
+    '/api/v1/film/{uuid}': 'high',
+    '/api/v1/person/{uuid}': 'high',
+    '/api/v1/genre/{uuid}': 'high',
+    '/api/v1/film/facets': 'low',
+    '/api/v1/film/batch': 'low',
+    '/api/v1/person/batch': 'low',
+    '/api/v1/film/export': 'low',
+    '/api/v1/person/export': 'low',
+}
+
+# Справочник жанров держится в памяти: как часто проверять поколение индекса и как часто перечитывать его в любом случае
+GENRE_CATALOGUE_CHECK_S = float(os.getenv('GENRE_CATALOGUE_CHECK_S', 5))
+GENRE_CATALOGUE_REFRESH_S = float(os.getenv('GENRE_CATALOGUE_REFRESH_S', 60 * 10))
+
+# Префиксный индекс подсказок по названиям фильмов и именам персон: проверка поколения, полная перестройка,
+# размер накопленных точечных изменений, после которого они вливаются в основной индекс, и число подсказок
+SUGGEST_INDEX_CHECK_S = float(os.getenv('SUGGEST_INDEX_CHECK_S', 5))
+SUGGEST_INDEX_REFRESH_S = float(os.getenv('SUGGEST_INDEX_REFRESH_S', 60 * 10))
+SUGGEST_OVERLAY_MAX_SIZE = int(os.getenv('SUGGEST_OVERLAY_MAX_SIZE', 1000))
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
 
 # Корень проекта
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 PAGE_SIZE = 20
+
+# Максимальное количество идентификаторов в одном batch-запросе
+BATCH_MAX_IDS = int(os.getenv('BATCH_MAX_IDS', 100))
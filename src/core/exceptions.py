@@ -4,3 +4,12 @@ import typing
 class NotFoundError(BaseException):
     def __init__(self, error: typing.Optional[str] = None):
         self.error = error
+
+
+class ServiceUnavailableError(Exception):
+    """A backend is overloaded or down, the request may be retried after retry_after seconds."""
+
+    def __init__(self, error: typing.Optional[str] = None, retry_after: float = 1.0):
+        super().__init__(error)
+        self.error = error
+        self.retry_after = retry_after
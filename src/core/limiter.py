@@ -0,0 +1,175 @@
+"""Overload protection of a backend: adaptive concurrency limit with a priority queue and a circuit breaker.
+
+Both are process-local, every worker adapts to the latency it observes itself.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Optional
+
+from core import metrics
+from core.exceptions import ServiceUnavailableError
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# Доля очереди, доступная запросам приоритета: при росте очереди первыми отбрасываются низкоприоритетные
+_QUEUE_SHARE = {
+    Priority.HIGH: 1.0,
+    Priority.NORMAL: 0.75,
+    Priority.LOW: 0.25,
+}
+
+_priority: ContextVar[Priority] = ContextVar('priority', default=Priority.NORMAL)
+
+
+def get_priority() -> Priority:
+    return _priority.get()
+
+
+def set_priority(priority: Priority) -> None:
+    """Priority of the backend calls made by the current request or task."""
+    _priority.set(priority)
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit. While calls complete within latency_target_s and the limit is actually reached,
+    it grows by about one per limit calls; a slow or failed call shrinks it by the backoff factor, at most once
+    per latency_target_s so that a burst of slow calls counts as one congestion signal.
+
+    Calls over the limit wait in a priority queue. When the share of the queue available to their priority
+    is full, or they wait longer than queue_timeout_s, they are rejected with ServiceUnavailableError.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            initial: int,
+            min_limit: int,
+            max_limit: int,
+            latency_target_s: float,
+            backoff: float,
+            queue_size: int,
+            queue_timeout_s: float,
+            retry_after_s: float,
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target_s = latency_target_s
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.queue_timeout_s = queue_timeout_s
+        self.retry_after_s = retry_after_s
+        self.in_flight = 0
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._decreased_at = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(not future.done() for _, _, future in self._queue)
+
+    async def acquire(self, priority: Priority, reject: bool = True) -> None:
+        """Takes a slot, waiting in the queue when the limit is reached. With reject=False the call is never
+        rejected and waits as long as it takes, for calls that can no longer fail cleanly, e.g. the next page
+        of a response that has already started."""
+        if self.in_flight < int(self.limit) and not self.queued:
+            self.in_flight += 1
+            return
+
+        if reject and self.queued >= self.queue_size * _QUEUE_SHARE[priority]:
+            self._reject(priority, 'queue_full')
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), future))
+        try:
+            await asyncio.wait_for(future, self.queue_timeout_s if reject else None)
+        except asyncio.TimeoutError:
+            self._reject(priority, 'timeout')
+        except BaseException:
+            # Слот мог быть выдан одновременно с отменой ожидания
+            if future.done() and not future.cancelled():
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, latency_s: float, overloaded: bool = False) -> None:
+        """Returns the slot and adapts the limit to the outcome of the call."""
+        at_limit = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        now = time.monotonic()
+        if overloaded or latency_s > self.latency_target_s:
+            if now - self._decreased_at >= self.latency_target_s:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._decreased_at = now
+        elif at_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._queue and self.in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _reject(self, priority: Priority, reason: str) -> None:
+        metrics.registry.inc(
+            'limiter_rejected_total', backend=self.name, priority=priority.name.lower(), reason=reason,
+        )
+        raise ServiceUnavailableError(f'{self.name} is overloaded', retry_after=self.retry_after_s)
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failed calls: while it is open calls fail immediately with
+    ServiceUnavailableError. After reset_s one probe call is let through (half-open), its outcome closes
+    the breaker or opens it again."""
+
+    def __init__(self, name: str, failures: int, reset_s: float):
+        self.name = name
+        self.failures = failures
+        self.reset_s = reset_s
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> bool:
+        """Rejects the call while the breaker is open. True when the call is the probe of the half-open breaker:
+        its caller must end it with success(), failure() or abandon(), otherwise the breaker stays half-open."""
+        if self.opened_at is None:
+            return False
+        remaining = self.opened_at + self.reset_s - time.monotonic()
+        if remaining > 0 or self._probing:
+            metrics.registry.inc('breaker_rejected_total', backend=self.name)
+            raise ServiceUnavailableError(f'{self.name} is unavailable', retry_after=max(remaining, 1))
+        self._probing = True
+        return True
+
+    def success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self) -> None:
+        self.consecutive_failures += 1
+        if self._probing or self.consecutive_failures >= self.failures:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def abandon(self) -> None:
+        """The call ended without an answer from the backend, e.g. it was cancelled."""
+        self._probing = False
@@ -1,5 +1,17 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueListener
+
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 LOG_DEFAULT_HANDLERS = ['console', ]
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Обработчики только форматируют запись и кладут её в очередь, в поток вывода пишет отдельный поток
+# QueueListener, так что запись логов не блокирует event loop
+LOG_QUEUE = queue.Queue()
 
 # В логгере настраивается логгирование uvicorn-сервера.
 # Про логирование в Python можно прочитать в документации
@@ -25,28 +37,29 @@ LOGGING = {
     },
     'handlers': {
         'console': {
-            'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
+            'level': LOG_LEVEL,
+            'class': 'logging.handlers.QueueHandler',
+            'queue': 'ext://core.logger.LOG_QUEUE',
             'formatter': 'verbose',
         },
         'default': {
             'formatter': 'default',
-            'class': 'logging.StreamHandler',
-            'stream': 'ext://sys.stdout',
+            'class': 'logging.handlers.QueueHandler',
+            'queue': 'ext://core.logger.LOG_QUEUE',
         },
         'access': {
             'formatter': 'access',
-            'class': 'logging.StreamHandler',
-            'stream': 'ext://sys.stdout',
+            'class': 'logging.handlers.QueueHandler',
+            'queue': 'ext://core.logger.LOG_QUEUE',
         },
     },
     'loggers': {
         '': {
             'handlers': LOG_DEFAULT_HANDLERS,
-            'level': 'INFO',
+            'level': LOG_LEVEL,
         },
         'uvicorn.error': {
-            'level': 'INFO',
+            'level': LOG_LEVEL,
         },
         'uvicorn.access': {
             'handlers': ['access'],
@@ -55,8 +68,23 @@ LOGGING = {
         },
     },
     'root': {
-        'level': 'INFO',
+        'level': LOG_LEVEL,
         'formatter': 'verbose',
         'handlers': LOG_DEFAULT_HANDLERS,
     },
 }
+
+_listener = None
+
+
+def start_log_listener() -> None:
+    """Starts the thread that writes queued records to stdout, once per process."""
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    # Записи уже отформатированы QueueHandler-ами
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _listener = QueueListener(LOG_QUEUE, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
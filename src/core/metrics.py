@@ -0,0 +1,120 @@
+"""Process-local request timings and metrics in the Prometheus text format.
+
+Hooks in the cache and ES layers add durations to the timings of the current request (kept in a context variable),
+the HTTP middleware turns them into per-route histograms and a Server-Timing header. With several workers every
+process exposes its own numbers.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from starlette.routing import Match
+from starlette.types import Scope
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_request_timings: ContextVar[Optional[dict[str, float]]] = ContextVar('request_timings', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict[str, str]) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = _labels(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        series = self.counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def route_label(scope: Scope) -> str:
+    """Path template of the route matching the request, so that neither every document nor every unknown path
+    gets its own series. 'unmatched' for the requests no route handles."""
+    for route in scope['app'].router.routes:
+        match, _ = route.matches(scope)
+        # PARTIAL - путь совпал, а метод нет, это тот же маршрут с ответом 405
+        if match != Match.NONE:
+            return route.path
+    return 'unmatched'
+
+
+def start_request() -> dict[str, float]:
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def add_timing(name: str, seconds: float) -> None:
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - started)
+
+
+def server_timing(timings: dict[str, float]) -> str:
+    return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items())
@@ -0,0 +1,206 @@
+import time
+import zlib
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Hashable, Optional
+
+import orjson
+
+from core import config
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+_MISSING = object()
+
+_bypass: ContextVar[bool] = ContextVar('cache_bypass', default=False)
+
+# Первый байт значения в Redis указывает способ его кодирования
+_RAW = b'j'
+_ZLIB = b'z'
+_LZ4 = b'l'
+
+
+class CacheStats:
+    def __init__(self, tier: str):
+        self.tier = tier
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.fallbacks = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'coalesced': self.coalesced,
+            'refreshes': self.refreshes,
+            'fallbacks': self.fallbacks,
+        }
+
+
+class CodecStats:
+    def __init__(self):
+        self.encoded = 0
+        self.decoded = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            'encoded': self.encoded,
+            'decoded': self.decoded,
+            'compressed': self.compressed,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'bytes_saved': self.raw_bytes - self.stored_bytes,
+            'encode_seconds': self.encode_seconds,
+            'decode_seconds': self.decode_seconds,
+        }
+
+
+def encode_value(value: Any) -> tuple[bytes, int]:
+    """Serializes a value for Redis, compressing it when it is large enough to be worth the CPU.
+    Returns the data and the length of the uncompressed JSON, the size estimate of the value for LocalCache."""
+    started = time.perf_counter()
+    raw = orjson.dumps(value)
+    data = _RAW + raw
+    if len(raw) >= config.CACHE_COMPRESS_MIN_BYTES:
+        if config.CACHE_COMPRESSION == 'lz4' and lz4 is not None:
+            data = _LZ4 + lz4.compress(raw)
+        elif config.CACHE_COMPRESSION in ('zlib', 'lz4'):
+            data = _ZLIB + zlib.compress(raw, 1)
+
+    codec_stats.encoded += 1
+    codec_stats.compressed += data[:1] != _RAW
+    codec_stats.raw_bytes += len(raw)
+    codec_stats.stored_bytes += len(data)
+    codec_stats.encode_seconds += time.perf_counter() - started
+    return data, len(raw)
+
+
+def decode_value(data: bytes) -> tuple[Any, int]:
+    """The value and the length of its uncompressed JSON, see encode_value."""
+    started = time.perf_counter()
+    codec, payload = data[:1], data[1:]
+    if codec == _ZLIB:
+        payload = zlib.decompress(payload)
+    elif codec == _LZ4:
+        payload = lz4.decompress(payload)
+    elif codec != _RAW:
+        # Значение записано до появления заголовка кодека
+        payload = data
+    value = orjson.loads(payload)
+
+    codec_stats.decoded += 1
+    codec_stats.decode_seconds += time.perf_counter() - started
+    return value, len(payload)
+
+
+class LocalCache:
+    """In-process LRU cache with per-entry TTL, bounded by entry count and total bytes.
+
+    Values are stored already decoded and are shared between callers, so they must be treated as read-only.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, expire_s: float, stats: Optional[CacheStats] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expire_s = expire_s
+        self.stats = stats or CacheStats('local')
+        self.size_bytes = 0
+        # key -> (expires_at, size, value), oldest first
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.stats.misses += 1
+            return default
+
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, size: int, expire_s: Optional[float] = None) -> None:
+        expire_s = self.expire_s if expire_s is None else min(expire_s, self.expire_s)
+        if expire_s <= 0 or size > self.max_bytes:
+            return
+
+        if key in self._data:
+            self._remove(key)
+
+        self._data[key] = (time.monotonic() + expire_s, size, value)
+        self.size_bytes += size
+
+        while len(self._data) > self.max_entries or self.size_bytes > self.max_bytes:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.stats.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size_bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._data.pop(key)
+        self.size_bytes -= size
+
+
+def cache_bypassed() -> bool:
+    return _bypass.get()
+
+
+def bypass_cache() -> None:
+    """Cached values are not read within the current task, they are recomputed and written again.
+    Used by the cache warm-up to refresh entries before they expire."""
+    _bypass.set(True)
+
+
+# Счётчики общие для процесса, как и реестр метрик, даже если в нём несколько приложений со своими кешами
+local_stats = CacheStats('local')
+redis_stats = CacheStats('redis')
+response_stats = CacheStats('response')
+codec_stats = CodecStats()
+
+
+def create_local_cache() -> LocalCache:
+    return LocalCache(
+        max_entries=config.LOCAL_CACHE_MAX_ENTRIES,
+        max_bytes=config.LOCAL_CACHE_MAX_BYTES,
+        expire_s=config.LOCAL_CACHE_EXPIRE_S,
+        stats=local_stats,
+    )
+
+
+def get_cache_stats() -> dict[str, dict[str, float]]:
+    return {
+        'local': local_stats.as_dict(),
+        'redis': redis_stats.as_dict(),
+        'response': response_stats.as_dict(),
+        'codec': codec_stats.as_dict(),
+    }
@@ -1,21 +1,313 @@
-from elasticsearch import AsyncElasticsearch
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from hashlib import sha1
+from typing import AsyncIterator, Optional, Union
 
-from db.redis import redis_cache
+import aiohttp
+from elasticsearch import AIOHttpConnection, AsyncElasticsearch
+from elasticsearch import exceptions as es_exceptions
+# Внутренности клиента для KeepAliveConnection, поэтому elasticsearch закреплён в pyproject.toml на 7.13.x
+from elasticsearch._async.http_aiohttp import ESClientResponse, get_running_loop
+
+from core import config, metrics
+from core.exceptions import ServiceUnavailableError
+from core.limiter import AdaptiveLimiter, CircuitBreaker, get_priority
+from db.redis import RedisCache, redis_cache
+
+logger = logging.getLogger(__name__)
+
+# Служебные поля ответа ES, которые сервисам не нужны и не должны занимать место в кеше
+_RESPONSE_META = ('_shards', 'timed_out', '_index', '_type', '_version', '_seq_no', '_primary_term')
+_HIT_META = ('_index', '_type', '_score')
+
+# Ответы ES, означающие, что он перегружен или недоступен, а не что запрос неверен
+_UNAVAILABLE_STATUSES = (429, 502, 503, 504)
+
+# Поля ответов, которые читают сервисы, остальное ES не передаёт (параметр filter_path)
+SEARCH_FILTER_PATH = ','.join([
+    'took',
+    '_scroll_id',
+    'hits.total',
+    'hits.hits._id',
+    'hits.hits._source',
+    'hits.hits.sort',
+    'hits.hits.fields',
+    'aggregations',
+])
+AGGREGATIONS_FILTER_PATH = 'took,hits.total,aggregations'
+SCROLL_FILTER_PATH = '_scroll_id,hits.hits._id,hits.hits._source'
+GET_FILTER_PATH = '_id,found,_source'
+MGET_FILTER_PATH = 'docs._id,docs.found,docs._source'
+
+
+def compact_response(resp: dict) -> dict:
+    for field in _RESPONSE_META:
+        resp.pop(field, None)
+
+    hits = resp.get('hits')
+    if hits:
+        hits.pop('max_score', None)
+        for hit in hits.get('hits', ()):
+            for field in _HIT_META:
+                hit.pop(field, None)
+    return resp
+
+
+class SearchTemplate:
+    """Mustache search template stored in ES. The id contains a hash of the source, so workers running
+    different versions of a template never overwrite each other's."""
+
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.source = source
+        self.id = f'{name}-{sha1(source.encode()).hexdigest()[:12]}'
+
+
+def _filter_path(path: str) -> dict:
+    return {'filter_path': path} if config.ELASTIC_FILTER_PATH_ENABLED else {}
+
+
+class KeepAliveConnection(AIOHttpConnection):
+    """AIOHttpConnection whose pooled sockets stay open for ELASTIC_KEEP_ALIVE_S between requests
+    (aiohttp closes them after 15 seconds by default)."""
+
+    # AIOHttpConnection не принимает ни keepalive_timeout, ни свой коннектор, поэтому копируем его приватный
+    # _create_aiohttp_session из elasticsearch 7.13 с одним изменением. При обновлении клиента сверить с оригиналом
+    async def _create_aiohttp_session(self):
+        if self.loop is None:
+            self.loop = get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=('accept', 'accept-encoding'),
+            auto_decompress=True,
+            loop=self.loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit,
+                use_dns_cache=True,
+                ssl=self._ssl_context,
+                keepalive_timeout=config.ELASTIC_KEEP_ALIVE_S,
+            ),
+        )
 
 
 class WrappedAsyncElasticsearch(AsyncElasticsearch):
+    """AsyncElasticsearch whose reads are cached in `cache` and whose calls go through the overload protection
+    of this client, so that neither is shared with other clients of the process."""
+
+    def __init__(
+            self,
+            *args,
+            cache: RedisCache,
+            limiter: Optional[AdaptiveLimiter] = None,
+            breaker: Optional[CircuitBreaker] = None,
+            **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.limiter = limiter if limiter is not None else create_limiter()
+        self.breaker = breaker if breaker is not None else create_breaker()
+        # Шаблоны поиска этого клиента по id, чтобы сохранить заново пропавший из кластера
+        self._templates: dict[str, SearchTemplate] = {}
 
     @redis_cache
-    async def get(self, *args, **kwargs):
-        return await super().get(*args, **kwargs)
+    async def get(self, index, id, **kwargs):
+        async with self._guarded('get', index):
+            return compact_response(await super().get(index, id, **{**_filter_path(GET_FILTER_PATH), **kwargs}))
 
     @redis_cache
-    async def search(self, *args, **kwargs):
-        return await super().search(*args, **kwargs)
+    async def search(self, body=None, index=None, **kwargs):
+        async with self._guarded('search', index):
+            resp = await super().search(body=body, index=index, **{**_filter_path(SEARCH_FILTER_PATH), **kwargs})
+        return self._search_result(resp, index)
+
+    @redis_cache
+    async def search_template(self, body, index=None, **kwargs):
+        try:
+            return await self._search_template(body, index, **kwargs)
+        except es_exceptions.NotFoundError as e:
+            template = self._templates.get(body.get('id'))
+            if template is None or e.error != 'resource_not_found_exception':
+                raise
+        # Шаблона нет в кластере: его не удалось сохранить при старте или ES перезапущен без данных
+        logger.warning('Search template %s is missing in Elasticsearch, storing it again', template.id)
+        await self.put_search_templates([template])
+        return await self._search_template(body, index, **kwargs)
+
+    async def _search_template(self, body, index, **kwargs):
+        async with self._guarded('search_template', index):
+            resp = await super().search_template(
+                body=body, index=index, **{**_filter_path(SEARCH_FILTER_PATH), **kwargs}
+            )
+        return self._search_result(resp, index)
+
+    @redis_cache(expire_s=config.AGGREGATIONS_CACHE_EXPIRE_S)
+    async def aggregate(self, body, index, **kwargs):
+        """Search without hits, for total counts and aggregations. The cache key carries the index generation,
+        so the result is kept until the index changes instead of for the usual TTL."""
+        async with self._guarded('aggregate', index):
+            resp = await super().search(
+                body=body, index=index, size=0, **{**_filter_path(AGGREGATIONS_FILTER_PATH), **kwargs}
+            )
+        return self._search_result(resp, index)
+
+    async def put_search_templates(self, templates: list[SearchTemplate]) -> None:
+        for template in templates:
+            self._templates[template.id] = template
+            await self.put_script(id=template.id, body={'script': {'lang': 'mustache', 'source': template.source}})
+
+    @staticmethod
+    def _search_result(resp: dict, index: str) -> dict:
+        # С filter_path ES не возвращает пустой список попаданий
+        resp.setdefault('hits', {}).setdefault('hits', [])
+        if 'took' in resp:
+            metrics.add_timing('es_took', resp['took'] / 1000)
+            metrics.registry.observe('es_took_seconds', resp['took'] / 1000, index=index)
+        return compact_response(resp)
+
+    @asynccontextmanager
+    async def _guarded(self, method: str, index: str, admission: bool = True) -> AsyncIterator[None]:
+        """Runs an ES call within the circuit breaker and the concurrency limit and records its duration.
+        Connection errors and overload responses of ES are raised as ServiceUnavailableError.
+
+        With admission=False the call continues work that was already admitted: it is neither stopped by the
+        open breaker nor rejected by the limiter, only waits for a slot."""
+        probe = self.breaker.check() if admission else False
+        try:
+            await self.limiter.acquire(get_priority(), reject=admission)
+        except BaseException:
+            # Пробный запрос не дошёл до ES (очередь полна, таймаут, отмена): иначе breaker остался бы полуоткрытым
+            if probe:
+                self.breaker.abandon()
+            raise
+        started = time.perf_counter()
+        failed = None
+        try:
+            yield
+            failed = False
+        except es_exceptions.TransportError as e:
+            if isinstance(e, es_exceptions.ConnectionError) or e.status_code in _UNAVAILABLE_STATUSES:
+                failed = True
+                raise ServiceUnavailableError(f'Elasticsearch is unavailable: {e}') from e
+            failed = False
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.limiter.release(elapsed, overloaded=bool(failed))
+            if failed is None:
+                self.breaker.abandon()
+            elif failed:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            metrics.add_timing('es', elapsed)
+            metrics.registry.observe('es_request_seconds', elapsed, method=method, index=index)
+
+    async def mget_by_ids(
+            self, index: str, ids: list[str], source: Optional[list[str]] = None
+    ) -> list[Optional[dict]]:
+        """Documents in the order of ids, None for the missing ones. Reuses the cache entries of get()
+        with the same _source_includes, so only ids that are not cached go to ES, in a single mget."""
+        params = {'index': index, '_source_includes': source} if source is not None else {'index': index}
+        # Ключи считаются одновременно, чтобы версии документов читались из Redis одним конвейером
+        keys = dict(zip(ids, await asyncio.gather(*[
+            self.cache.cache_key('get', {**params, 'id': doc_id}) for doc_id in ids
+        ])))
+        docs = await self.cache.get_many([keys[doc_id] for doc_id in ids])
+
+        missing = list({ids[i] for i, doc in enumerate(docs) if doc is None})
+        if not missing:
+            return docs
+
+        started = time.monotonic()
+        try:
+            async with self._guarded('mget', index):
+                resp = await super().mget(
+                    body={'ids': missing}, index=index, _source_includes=source, **_filter_path(MGET_FILTER_PATH)
+                )
+        except ServiceUnavailableError:
+            stale = dict(zip(missing, await self.cache.get_many([keys[doc_id] for doc_id in missing], fallback=True)))
+            if any(doc is None for doc in stale.values()):
+                raise
+            return [doc if doc is not None else stale[doc_id] for doc_id, doc in zip(ids, docs)]
+        delta = time.monotonic() - started
+
+        found = {}
+        for doc in resp['docs']:
+            if doc.get('found'):
+                found[doc['_id']] = compact_response(doc)
+        for doc_id, doc in found.items():
+            await self.cache.set(keys[doc_id], doc, delta)
+
+        return [doc if doc is not None else found.get(doc_id) for doc_id, doc in zip(ids, docs)]
+
+    async def scan(
+            self,
+            index: str,
+            query: Optional[dict] = None,
+            source: Union[bool, list[str]] = True,
+            keep_alive: str = config.ELASTIC_SCROLL_KEEP_ALIVE,
+    ) -> AsyncIterator[dict]:
+        """Yields every matching hit of an index page by page with scroll. Goes straight to ES,
+        full scans are never cached. Only the first page can be rejected as overload."""
+        async with self._guarded('scan', index):
+            resp = await super().search(
+                index=index,
+                body={'query': query or {'match_all': {}}, 'sort': ['_doc'], '_source': source},
+                size=config.ELASTIC_SCAN_PAGE_SIZE,
+                scroll=keep_alive,
+                **_filter_path(SCROLL_FILTER_PATH),
+            )
+        scroll_id = resp.get('_scroll_id')
+        try:
+            while resp.get('hits', {}).get('hits'):
+                for hit in resp['hits']['hits']:
+                    yield hit
+                # Следующие страницы уже начатого обхода: отказ оборвал бы, например, выгрузку, ответ которой
+                # уже отправляется клиенту, поэтому допуск проверяется только для первой страницы
+                async with self._guarded('scroll', index, admission=False):
+                    resp = await super().scroll(
+                        body={'scroll_id': scroll_id},
+                        scroll=keep_alive,
+                        **_filter_path(SCROLL_FILTER_PATH),
+                    )
+                scroll_id = resp.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                await super().clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+
+
+def create_limiter() -> AdaptiveLimiter:
+    return AdaptiveLimiter(
+        'elasticsearch',
+        initial=config.ELASTIC_LIMITER_INITIAL,
+        min_limit=config.ELASTIC_LIMITER_MIN,
+        max_limit=config.ELASTIC_LIMITER_MAX,
+        latency_target_s=config.ELASTIC_LIMITER_LATENCY_TARGET_S,
+        backoff=config.ELASTIC_LIMITER_BACKOFF,
+        queue_size=config.ELASTIC_LIMITER_QUEUE_SIZE,
+        queue_timeout_s=config.ELASTIC_LIMITER_QUEUE_TIMEOUT_S,
+        retry_after_s=config.ELASTIC_LIMITER_RETRY_AFTER_S,
+    )
 
 
-async def get_elastic() -> WrappedAsyncElasticsearch:
-    return es
+def create_breaker() -> CircuitBreaker:
+    return CircuitBreaker(
+        'elasticsearch', failures=config.ELASTIC_BREAKER_FAILURES, reset_s=config.ELASTIC_BREAKER_RESET_S,
+    )
 
 
-es: WrappedAsyncElasticsearch = None
+def create_elastic(cache: RedisCache) -> WrappedAsyncElasticsearch:
+    return WrappedAsyncElasticsearch(
+        hosts=[f'{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'],
+        connection_class=KeepAliveConnection,
+        maxsize=config.ELASTIC_MAX_CONNECTIONS,
+        http_compress=config.ELASTIC_HTTP_COMPRESS,
+        timeout=config.ELASTIC_TIMEOUT_S,
+        max_retries=config.ELASTIC_MAX_RETRIES,
+        retry_on_timeout=config.ELASTIC_RETRY_ON_TIMEOUT,
+        cache=cache,
+    )
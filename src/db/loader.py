@@ -0,0 +1,80 @@
+import asyncio
+from typing import Optional
+
+from elasticsearch import exceptions as es_exceptions
+
+from db.elastic import WrappedAsyncElasticsearch
+
+# Группа документов, читаемых одним запросом к ES: index и _source_includes (None - весь документ)
+_Batch = tuple[str, Optional[tuple[str, ...]]]
+
+
+class DocumentLoader:
+    """Request-scoped batching and deduplication of document reads by id, dataloader-style.
+
+    load() calls made within one event-loop tick for the same index and source fields are answered by a single
+    read, and every document is read at most once per request. A single id goes to the cached get(), so that
+    concurrent requests for one document are still coalesced with each other; several ids go to mget_by_ids(),
+    which reuses the same cache entries. The Redis commands of both are pipelined by PipelinedCache.
+    """
+
+    def __init__(self, elastic: WrappedAsyncElasticsearch):
+        self.elastic = elastic
+        self._docs: dict[tuple[str, Optional[tuple[str, ...]], str], asyncio.Future] = {}
+        self._pending: dict[_Batch, list[str]] = {}
+        self._reads: set[asyncio.Task] = set()
+        self._scheduled = False
+
+    def load(self, index: str, doc_id: str, source: Optional[list[str]] = None) -> asyncio.Future:
+        """Future of the document, None if there is no such document."""
+        batch = (index, tuple(source) if source is not None else None)
+        future = self._docs.get((*batch, doc_id))
+        if future is not None:
+            return future
+
+        future = asyncio.get_event_loop().create_future()
+        self._docs[(*batch, doc_id)] = future
+        self._pending.setdefault(batch, []).append(doc_id)
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_event_loop().call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, index: str, ids: list[str], source: Optional[list[str]] = None) -> list[Optional[dict]]:
+        return list(await asyncio.gather(*[self.load(index, doc_id, source) for doc_id in ids]))
+
+    def _dispatch(self) -> None:
+        self._scheduled = False
+        pending, self._pending = self._pending, {}
+        for (index, source), ids in pending.items():
+            task = asyncio.ensure_future(self._read(index, source, ids))
+            self._reads.add(task)
+            task.add_done_callback(self._reads.discard)
+
+    async def _read(self, index: str, source: Optional[tuple[str, ...]], ids: list[str]) -> None:
+        futures = [self._docs[(index, source, doc_id)] for doc_id in ids]
+        try:
+            docs = await self._fetch(index, list(source) if source is not None else None, ids)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, doc in zip(futures, docs):
+            # Ожидание могло быть отменено вместе с запросом
+            if not future.done():
+                future.set_result(doc)
+
+    async def _fetch(self, index: str, source: Optional[list[str]], ids: list[str]) -> list[Optional[dict]]:
+        if len(ids) > 1:
+            return await self.elastic.mget_by_ids(index, ids, source=source)
+
+        kwargs = {'_source_includes': source} if source is not None else {}
+        try:
+            return [await self.elastic.get(index, ids[0], **kwargs)]
+        except es_exceptions.NotFoundError as e:
+            # Нет документа - это None, как в mget; нет индекса - ошибка
+            if isinstance(e.info, dict) and e.info.get('found') is False:
+                return [None]
+            raise
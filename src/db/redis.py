@@ -1,30 +1,528 @@
+import asyncio
+import inspect
+import logging
+import math
+import random
+import time
+import uuid
 from functools import wraps
 from hashlib import sha1
+from typing import Any, Awaitable, Callable, Optional
 
 import orjson
 from aioredis import Redis
 
-from core.config import REDIS_CACHE_EXPIRE_S
+from core import config, metrics
+from core.exceptions import ServiceUnavailableError
+from core.limiter import Priority, set_priority
+from db.cache import (
+    CacheStats, LocalCache, cache_bypassed, create_local_cache, decode_value, encode_value, redis_stats,
+)
 
-redis: Redis = None
+logger = logging.getLogger(__name__)
 
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
-async def get_redis() -> Redis:
-    return redis
 
+class PipelinedCache:
+    """GET/SET front-end over the Redis pool that collects commands issued within one event-loop tick
+    and sends them to Redis as a single pipeline. SETs are fire-and-forget."""
 
-def redis_cache(fn):
-    @wraps(fn)
-    async def wrapper(*args, **kwargs):
-        redis = await get_redis()
-        keys = ('prefix', fn.__name__,) + args + tuple(sorted(kwargs.items()))
-        key = sha1(str(keys).encode()).hexdigest()
-        data = await redis.get(key)
-        if not data:
-            result = await fn(*args, **kwargs)
-            await redis.set(key, orjson.dumps(result), expire=REDIS_CACHE_EXPIRE_S)
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._gets: dict[str, list[asyncio.Future]] = {}
+        self._sets: list[tuple[str, bytes, int]] = []
+        self._flushes: set[asyncio.Task] = set()
+        self._scheduled = False
+
+    def get(self, key: str) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._gets.setdefault(key, []).append(future)
+        self._schedule()
+        return future
+
+    async def mget(self, *keys: str) -> list[Optional[bytes]]:
+        return list(await asyncio.gather(*[self.get(key) for key in keys]))
+
+    def set(self, key: str, value: bytes, expire: int = 0) -> None:
+        self._sets.append((key, value, expire))
+        self._schedule()
+
+    async def drain(self) -> None:
+        """Waits until every queued command has been sent, used on shutdown."""
+        while self._scheduled or self._flushes:
+            await asyncio.sleep(0)
+            if self._flushes:
+                await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _schedule(self) -> None:
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._scheduled = False
+        gets, self._gets = self._gets, {}
+        sets, self._sets = self._sets, []
+        task = asyncio.ensure_future(self._execute(gets, sets))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _execute(self, gets: dict[str, list[asyncio.Future]], sets: list[tuple[str, bytes, int]]) -> None:
+        pipeline = self.redis.pipeline()
+        keys = list(gets)
+        for key in keys:
+            pipeline.get(key)
+        for key, value, expire in sets:
+            pipeline.set(key, value, expire=expire)
+
+        try:
+            results = await pipeline.execute(return_exceptions=True)
+        except Exception as e:
+            results = [e] * (len(keys) + len(sets))
+
+        for key, result in zip(keys, results):
+            for future in gets[key]:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        for (key, _, _), result in zip(sets, results[len(keys):]):
+            if isinstance(result, Exception):
+                logger.warning('Failed to write cache key %s: %r', key, result)
+
+
+def _generation_key(index: str) -> str:
+    return f'cache:generation:{index}'
+
+
+def _pages_generation_key(index: str) -> str:
+    return f'cache:pages_generation:{index}'
+
+
+def _doc_variants_key(index: str) -> str:
+    return f'cache:doc_variants:{index}'
+
+
+def _doc_version_key(index: str, doc_id: str) -> str:
+    return f'cache:doc_version:{index}:{doc_id}'
+
+
+def _canonical_params(signature: inspect.Signature, args, kwargs) -> dict[str, Any]:
+    bound = signature.bind(*args, **kwargs)
+    params = {}
+    for name, value in bound.arguments.items():
+        parameter = signature.parameters[name]
+        if name == 'self':
+            continue
+        if parameter.kind is inspect.Parameter.VAR_KEYWORD:
+            params.update(value)
         else:
-            result = orjson.loads(data)
+            params[name] = value
+    return {name: value for name, value in params.items() if value is not None}
+
+
+def _index_of(key: str) -> str:
+    return key.split(':', 2)[1]
+
+
+def _doc_key(index: str, generation: int, doc_id: str, version: int, variant: str) -> str:
+    return f'cache:{index}:{generation}:doc:{doc_id}:{version}:{variant}'
+
+
+async def _acquire_lock(redis: Redis, key: str) -> Optional[str]:
+    token = uuid.uuid4().hex
+    acquired = await redis.set(
+        f'lock:{key}',
+        token,
+        pexpire=int(config.REDIS_CACHE_LOCK_TIMEOUT_S * 1000),
+        exist=Redis.SET_IF_NOT_EXIST,
+    )
+    return token if acquired else None
+
+
+async def _release_lock(redis: Redis, key: str, token: str) -> None:
+    await redis.eval(_RELEASE_LOCK_SCRIPT, keys=[f'lock:{key}'], args=[token])
+
+
+async def _wait_for_value(cache: PipelinedCache, key: str) -> Optional[tuple[dict, int]]:
+    """Waits for the lock holder to write the entry. An expired entry is accepted only if it was written while
+    waiting, not the one being replaced. None when the lock was released without such an entry or the wait timed out.
+    """
+    data = await cache.get(key)
+    seen = decode_value(data)[0]['e'] if data else None
+    deadline = time.monotonic() + config.REDIS_CACHE_LOCK_TIMEOUT_S
+    while time.monotonic() < deadline:
+        await asyncio.sleep(config.REDIS_CACHE_LOCK_POLL_S)
+        data, locked = await cache.mget(key, f'lock:{key}')
+        if data:
+            entry, size = decode_value(data)
+            if not _is_expired(entry) or seen is None or entry['e'] > seen:
+                return entry, size
+        if not locked:
+            return None
+    return None
+
+
+def _encode_entry(result: Any, delta: float, expire_s: int = config.REDIS_CACHE_EXPIRE_S) -> tuple[bytes, int]:
+    # v - значение, d - время его вычисления, e - момент мягкого истечения
+    return encode_value({'v': result, 'd': delta, 'e': time.time() + expire_s})
+
+
+def _redis_expire(expire_s: int) -> int:
+    """Entries outlive their stale window by REDIS_CACHE_FALLBACK_S to be served when ES is unavailable."""
+    return expire_s + config.REDIS_CACHE_STALE_S + config.REDIS_CACHE_FALLBACK_S
+
+
+def _is_expired(entry: dict) -> bool:
+    """The entry is past its stale window and is served only as a fallback."""
+    return time.time() >= entry['e'] + config.REDIS_CACHE_STALE_S
+
+
+def _fresh_for(entry: dict) -> float:
+    """Seconds until the entry should be recomputed, XFetch-style: the closer to the soft expiry
+    and the more expensive the value was to compute, the more likely an early refresh is."""
+    early = -entry['d'] * config.REDIS_CACHE_XFETCH_BETA * math.log(1.0 - random.random())
+    return entry['e'] - time.time() - early
+
+
+def _count_lookup(index: str, tier: str, hit: bool) -> None:
+    metrics.registry.inc('cache_lookups_total', index=index, tier=tier, result='hit' if hit else 'miss')
+
+
+class RedisCache:
+    """Cache of one application: the in-process LRU tier in front of Redis, the index generations that
+    namespace the keys and the recomputations in flight.
+
+    It is created by main.startup and kept in AppState, so two applications in one process, e.g. in tests,
+    never share entries, generations or the Redis pool. Only the hit/miss counters are process-wide.
+    """
+
+    def __init__(self, redis: Redis, local: Optional[LocalCache] = None):
+        self.redis = redis
+        self.pipeline = PipelinedCache(redis)
+        self.local = local if local is not None else create_local_cache()
+        # Поколения индексов: generation key -> (generation, monotonic time of the last read from Redis)
+        self._generations: dict[str, tuple[int, float]] = {}
+        # Варианты чтения документа (имя метода и хеш остальных параметров, например _source_includes), которые
+        # уже зарегистрированы в Redis: index -> variants
+        self._doc_variants: dict[str, set[str]] = {}
+        # Версии документов, которые входят в их ключи: (index, id) -> version, перечитываются из Redis так же часто,
+        # как поколения. Размер каждой записи 1, поэтому max_bytes ограничивает то же, что max_entries
+        self._doc_versions = LocalCache(
+            max_entries=config.CACHE_DOC_VERSIONS_MAX_ENTRIES,
+            max_bytes=config.CACHE_DOC_VERSIONS_MAX_ENTRIES,
+            expire_s=config.CACHE_GENERATION_REFRESH_S,
+            stats=CacheStats('doc_versions'),
+        )
+        # Незавершённые пересчёты ключей: key -> future
+        self._inflight: dict[str, asyncio.Future] = {}
+        # Фоновые задачи обновления устаревших ключей, ссылки держим, чтобы их не собрал GC
+        self._background: set[asyncio.Task] = set()
+
+    async def drain(self) -> None:
+        """Waits until every queued Redis command has been sent, used on shutdown."""
+        await self.pipeline.drain()
+
+    async def _read_generation(self, key: str) -> int:
+        cached = self._generations.get(key)
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < config.CACHE_GENERATION_REFRESH_S:
+            return cached[0]
+
+        generation = int(await self.pipeline.get(key) or 0)
+        self._generations[key] = (generation, now)
+        return generation
+
+    async def _bump(self, key: str) -> int:
+        generation = await self.redis.incr(key)
+        self._generations[key] = (generation, time.monotonic())
+        return generation
+
+    async def get_generation(self, index: str) -> int:
+        """Current cache generation of an index, re-read from Redis at most every CACHE_GENERATION_REFRESH_S."""
+        return await self._read_generation(_generation_key(index))
+
+    async def get_pages_generation(self, index: str) -> int:
+        """Generation of the entries that depend on many documents of an index: searches, lists, aggregations."""
+        return await self._read_generation(_pages_generation_key(index))
+
+    async def bump_generation(self, index: str) -> int:
+        """Invalidates every cached entry of an index at once: keys of the old generation are never read again
+        and simply expire."""
+        return await self._bump(_generation_key(index))
+
+    async def bump_pages_generation(self, index: str) -> int:
+        """Invalidates the searches, lists and aggregations of an index, cached documents stay."""
+        return await self._bump(_pages_generation_key(index))
+
+    def forget_generations(self, index: Optional[str] = None) -> None:
+        """Makes the next cache_key() re-read the generations of an index (of all indices by default) from Redis."""
+        if index is None:
+            self._generations.clear()
+            # Redis могли очистить вместе с множествами вариантов, при следующем чтении они зарегистрируются заново
+            self._doc_variants.clear()
+            self._doc_versions.clear()
+            return
+        self._generations.pop(_generation_key(index), None)
+        self._generations.pop(_pages_generation_key(index), None)
+
+    async def get_doc_version(self, index: str, doc_id: str) -> int:
+        """Version of a document in its cache keys, bumped by evict_docs(). Re-read from Redis at most every
+        CACHE_GENERATION_REFRESH_S."""
+        version = self._doc_versions.get((index, doc_id))
+        if version is None:
+            version = int(await self.pipeline.get(_doc_version_key(index, doc_id)) or 0)
+            self._doc_versions.set((index, doc_id), version, 1)
+        return version
+
+    async def _register_doc_variant(self, index: str, variant: str) -> None:
+        known = self._doc_variants.setdefault(index, set())
+        if variant in known:
+            return
+        await self.redis.sadd(_doc_variants_key(index), variant)
+        known.add(variant)
+
+    async def cache_key(self, name: str, params: dict[str, Any]) -> str:
+        """Key that depends only on the meaning of the call: index namespace and generation plus a hash
+        of the normalized parameters.
+
+        Reads of a single document (params with an id) get a key of their own per document, so that evict_docs()
+        can delete them. Every other key also carries the pages generation of the index."""
+        index = params.get('index', '_')
+        generation = await self.get_generation(index)
+        doc_id = params.get('id')
+        if doc_id is not None:
+            rest = {name: value for name, value in params.items() if name != 'id'}
+            variant = f'{name}:{sha1(orjson.dumps(rest, option=orjson.OPT_SORT_KEYS)).hexdigest()}'
+            await self._register_doc_variant(index, variant)
+            return _doc_key(index, generation, doc_id, await self.get_doc_version(index, doc_id), variant)
+
+        pages_generation = await self.get_pages_generation(index)
+        digest = sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        return f'cache:{index}:{generation}.{pages_generation}:{name}:{digest}'
+
+    async def evict_docs(self, index: str, ids: list[str], from_redis: bool = True) -> None:
+        """Deletes the cached reads of the documents in every variant from the local tier and, with from_redis,
+        from Redis.
+
+        With from_redis the versions of the documents are bumped as well, which changes their keys: a read of the old
+        document still in flight, here or in another worker, then writes it under a key that is never read again.
+        """
+        generation = await self.get_generation(index)
+        variants = set(self._doc_variants.get(index, ()))
+        if from_redis:
+            variants.update(await self.redis.smembers(_doc_variants_key(index), encoding='utf-8'))
+            versions = await asyncio.gather(*[self.redis.incr(_doc_version_key(index, doc_id)) for doc_id in ids])
+            old_versions = {}
+            for doc_id, version in zip(ids, versions):
+                old_versions[doc_id] = version - 1
+                self._doc_versions.set((index, doc_id), version, 1)
+        else:
+            # Новую версию воркер прочитает из Redis при следующем чтении документа. Если старая уже забыта,
+            # записи локального кеша с ней никто не прочитает, они вытеснятся сами
+            old_versions = {doc_id: self._doc_versions.get((index, doc_id)) for doc_id in ids}
+            for doc_id in ids:
+                self._doc_versions.delete((index, doc_id))
+
+        keys = [
+            _doc_key(index, generation, doc_id, version, variant)
+            for doc_id, version in old_versions.items() if version is not None
+            for variant in variants
+        ]
+        for key in keys:
+            self.local.delete(key)
+        if from_redis and keys:
+            await self.redis.delete(*keys)
+
+    async def publish_invalidation(self, index: str, ids: Optional[list[str]] = None) -> int:
+        """Tells every API worker that documents of an index changed, without ids - that the whole index did,
+        so that they update their in-process caches. Returns the number of workers that received the message."""
+        message = {'index': index}
+        if ids is not None:
+            message['ids'] = ids
+        return await self.redis.publish(config.CACHE_INVALIDATION_CHANNEL, orjson.dumps(message))
+
+    async def invalidate_docs(self, index: str, ids: list[str]) -> int:
+        """Invalidates changed documents: deletes their cached reads and the searches and lists of the index
+        from Redis, then notifies the API workers. Redis is invalidated even when no worker is listening.
+        Returns the number of workers notified."""
+        await self.evict_docs(index, ids)
+        await self.bump_pages_generation(index)
+        return await self.publish_invalidation(index, ids)
+
+    async def invalidate_index(self, index: str) -> tuple[int, int]:
+        """Invalidates every cached entry of an index and notifies the API workers.
+        Returns the new generation and the number of workers notified."""
+        generation = await self.bump_generation(index)
+        return generation, await self.publish_invalidation(index)
+
+    async def single_flight(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs factory() once per key, concurrent callers with the same key await the same result."""
+        future = self._inflight.get(key)
+        if future is not None:
+            redis_stats.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(factory())
+        self._inflight[key] = future
+
+        def _forget(done: asyncio.Future):
+            if self._inflight.get(key) is done:
+                del self._inflight[key]
+
+        future.add_done_callback(_forget)
+        return await asyncio.shield(future)
+
+    async def _fill(self, key: str, factory: Callable[[], Awaitable[Any]], expire_s: int) -> Any:
+        token = None
+        if config.REDIS_CACHE_LOCK_ENABLED:
+            token = await _acquire_lock(self.redis, key)
+            if token is None:
+                # Ключ уже пересчитывает другой воркер, ждём его результата
+                written = await _wait_for_value(self.pipeline, key)
+                if written:
+                    redis_stats.coalesced += 1
+                    entry, size = written
+                    self.local.set(key, entry['v'], size, expire_s=max(_fresh_for(entry), 0))
+                    return entry['v']
+
+        try:
+            started = time.monotonic()
+            result = await factory()
+            data, size = _encode_entry(result, time.monotonic() - started, expire_s)
+            self.pipeline.set(key, data, expire=_redis_expire(expire_s))
+        finally:
+            if token is not None:
+                await _release_lock(self.redis, key, token)
+
+        self.local.set(key, result, size)
         return result
 
+    async def get_many(self, keys: list[str], fallback: bool = False) -> list[Any]:
+        """Fresh values of keys in the order given, None for misses and stale entries.
+        The local tier is checked first, the rest is read from Redis with a single MGET.
+        With fallback=True stale and expired entries are returned too, for when ES is unavailable."""
+        if cache_bypassed() and not fallback:
+            return [None] * len(keys)
+        with metrics.timer('cache'):
+            results = [self.local.get(key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is None]
+            for i, result in enumerate(results):
+                _count_lookup(_index_of(keys[i]), 'local', result is not None)
+            if not missing:
+                return results
+
+            for i, data in zip(missing, await self.pipeline.mget(*[keys[i] for i in missing])):
+                entry, size = decode_value(data) if data else (None, 0)
+                fresh_for = _fresh_for(entry) if entry else 0
+                _count_lookup(_index_of(keys[i]), 'redis', fresh_for > 0)
+                if entry and fallback:
+                    redis_stats.fallbacks += 1
+                    results[i] = entry['v']
+                    continue
+                if fresh_for <= 0:
+                    redis_stats.misses += 1
+                    continue
+                redis_stats.hits += 1
+                self.local.set(keys[i], entry['v'], size, expire_s=fresh_for)
+                results[i] = entry['v']
+            return results
+
+    async def set(self, key: str, value: Any, delta: float = 0.0) -> None:
+        data, size = _encode_entry(value, delta)
+        self.pipeline.set(key, data, expire=_redis_expire(config.REDIS_CACHE_EXPIRE_S))
+        self.local.set(key, value, size)
+
+    def _refresh_in_background(self, key: str, factory: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._inflight:
+            return
+
+        async def refresh():
+            # Обновление не ждёт ни один клиент, при перегрузке ES его запросы отбрасываются первыми
+            set_priority(Priority.LOW)
+            return await self.single_flight(key, factory)
+
+        redis_stats.refreshes += 1
+        task = asyncio.ensure_future(refresh())
+        self._background.add(task)
+
+        def _done(done: asyncio.Task):
+            self._background.discard(done)
+            if done.cancelled() or done.exception() is None:
+                return
+            if isinstance(done.exception(), ServiceUnavailableError):
+                logger.debug('Background refresh of cache key %s postponed: %s', key, done.exception().error)
+            else:
+                logger.warning('Background refresh of cache key %s failed: %r', key, done.exception())
+
+        task.add_done_callback(_done)
+
+    async def get_or_compute(
+            self, key: str, compute: Callable[[], Awaitable[Any]], expire_s: int = config.REDIS_CACHE_EXPIRE_S
+    ) -> Any:
+        """Value of key from the local tier or Redis, computed with compute() on a miss. A stale value is returned
+        at once and recomputed in the background, an expired one is returned only when ES is unavailable."""
+        started = time.perf_counter()
+        if cache_bypassed():
+            return await self.single_flight(key, lambda: self._fill(key, compute, expire_s))
+
+        index = _index_of(key)
+        result = self.local.get(key)
+        _count_lookup(index, 'local', result is not None)
+        if result is not None:
+            metrics.add_timing('cache', time.perf_counter() - started)
+            return result
+
+        data = await self.pipeline.get(key)
+        entry, size = decode_value(data) if data else (None, 0)
+        _count_lookup(index, 'redis', entry is not None and not _is_expired(entry))
+        if entry is None or _is_expired(entry):
+            redis_stats.misses += 1
+            metrics.add_timing('cache', time.perf_counter() - started)
+            try:
+                return await self.single_flight(key, lambda: self._fill(key, compute, expire_s))
+            except ServiceUnavailableError:
+                if entry is None:
+                    raise
+                # ES перегружен или недоступен: лучше старый ответ, чем ошибка
+                redis_stats.fallbacks += 1
+                return entry['v']
+
+        redis_stats.hits += 1
+        fresh_for = _fresh_for(entry)
+        if fresh_for > 0:
+            self.local.set(key, entry['v'], size, expire_s=fresh_for)
+        else:
+            # Отдаём устаревшее значение сразу, а пересчитываем его в фоне
+            self._refresh_in_background(key, lambda: self._fill(key, compute, expire_s))
+        metrics.add_timing('cache', time.perf_counter() - started)
+        return entry['v']
+
+
+def redis_cache(fn=None, *, expire_s: int = config.REDIS_CACHE_EXPIRE_S):
+    """Caches the result of a coroutine method in the RedisCache of its instance (self.cache) under cache_key().
+    Used both as @redis_cache and as @redis_cache(expire_s=...) for values that may live longer than
+    REDIS_CACHE_EXPIRE_S, e.g. ones that change only with the index generation."""
+    if fn is None:
+        return lambda fn: redis_cache(fn, expire_s=expire_s)
+
+    signature = inspect.signature(fn)
+
+    @wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        cache: RedisCache = self.cache
+        started = time.perf_counter()
+        key = await cache.cache_key(fn.__name__, _canonical_params(signature, (self, *args), kwargs))
+        metrics.add_timing('cache', time.perf_counter() - started)
+        return await cache.get_or_compute(key, lambda: fn(self, *args, **kwargs), expire_s)
+
     return wrapper
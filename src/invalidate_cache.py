@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+from typing import Optional
+
+import aioredis
+
+from core import config
+from db.redis import RedisCache
+
+
+async def main(indices: list[str], ids: Optional[list[str]]):
+    redis = await aioredis.create_redis_pool((config.REDIS_HOST, config.REDIS_PORT))
+    cache = RedisCache(redis)
+    try:
+        for index in indices:
+            if ids:
+                workers = await cache.invalidate_docs(index, ids)
+                print(f'{index}: {len(ids)} documents, notified {workers} workers')
+                continue
+            generation, workers = await cache.invalidate_index(index)
+            print(f'{index}: cache generation {generation}, notified {workers} workers')
+    finally:
+        await cache.drain()
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Invalidate cached entries of Elasticsearch indices: all of them or only the changed documents'
+    )
+    parser.add_argument('indices', nargs='+', help='index names, e.g. movies genres persons')
+    parser.add_argument('--id', action='append', dest='ids', help='changed document id, may be repeated')
+    args = parser.parse_args()
+    if args.ids and len(args.indices) > 1:
+        parser.error('document ids can be given for a single index only')
+    asyncio.run(main(args.indices, args.ids))
@@ -1,15 +1,28 @@
 import logging
+import math
+from http import HTTPStatus
 
 import aioredis
 import uvicorn as uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.responses import ORJSONResponse
 
+from api import metrics
+from api.middleware import HTTPMiddleware, PriorityMiddleware, metrics_middleware, response_cache_middleware
 from api.v1 import film, genre, person
 from core import config
+from core.exceptions import ServiceUnavailableError
 from core.logger import LOGGING
-from db import elastic, redis
-from db.elastic import WrappedAsyncElasticsearch
+from db.elastic import create_elastic
+from db.redis import RedisCache
+from services import film as film_services
+from services.genre import GenreCatalogue
+from services.invalidation import InvalidationListener
+from services.state import AppState
+from services.suggest import FilmSuggestIndex, PersonSuggestIndex
+from services.warmup import CacheWarmer
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title=config.PROJECT_NAME,
@@ -18,28 +31,80 @@ app = FastAPI(
     default_response_class=ORJSONResponse,
 )
 
+app.add_middleware(HTTPMiddleware, dispatch=response_cache_middleware)
+# Добавленный последним middleware выполняется первым, поэтому метрики охватывают и кеш ответов
+app.add_middleware(HTTPMiddleware, dispatch=metrics_middleware)
+app.add_middleware(PriorityMiddleware)
+
+
+@app.exception_handler(ServiceUnavailableError)
+async def service_unavailable_handler(request: Request, exc: ServiceUnavailableError) -> ORJSONResponse:
+    # Ответ без ожидания: ES перегружен или недоступен, а подходящей записи в кеше нет
+    return ORJSONResponse(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        content={'detail': exc.error},
+        headers={'Retry-After': str(max(1, math.ceil(exc.retry_after)))},
+    )
+
 
 @app.on_event('startup')
 async def startup():
-    redis.redis = await aioredis.create_redis_pool((config.REDIS_HOST, config.REDIS_PORT), minsize=10, maxsize=20)
-    elastic.es = WrappedAsyncElasticsearch(hosts=[f'{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'])
+    redis = await aioredis.create_redis_pool(
+        (config.REDIS_HOST, config.REDIS_PORT),
+        minsize=config.REDIS_POOL_MIN_SIZE,
+        maxsize=config.REDIS_POOL_MAX_SIZE,
+    )
+    cache = RedisCache(redis)
+    es = create_elastic(cache)
+    try:
+        await es.put_search_templates(film_services.SEARCH_TEMPLATES)
+    except Exception:
+        logger.exception('Search templates are not stored, they will be stored on first use')
+
+    state = AppState(cache, es, GenreCatalogue(es), FilmSuggestIndex(es), PersonSuggestIndex(es))
+    await state.load()
+    if config.CACHE_INVALIDATION_ENABLED:
+        # Подписка занимает соединение целиком, поэтому у неё своё соединение, а не пул
+        state.invalidation_listener = InvalidationListener(
+            (config.REDIS_HOST, config.REDIS_PORT),
+            cache,
+            state.genre_catalogue,
+            [state.film_suggest, state.person_suggest],
+        )
+    if config.CACHE_WARMUP_ENABLED:
+        state.warmer = CacheWarmer(app, redis, state.genre_catalogue)
+    app.state.services = state
+    state.start()
 
 
 @app.on_event('shutdown')
 async def shutdown():
-    await redis.redis.close()
-    await elastic.es.close()
+    state: AppState = app.state.services
+    await state.stop()
+    await state.cache.drain()
+    state.cache.redis.close()
+    await state.cache.redis.wait_closed()
+    await state.elastic.close()
 
 
 app.include_router(film.router, prefix='/api/v1/film', tags=['film'])
 app.include_router(genre.router, prefix='/api/v1/genre', tags=['genre'])
 app.include_router(person.router, prefix='/api/v1/person', tags=['person'])
+app.include_router(metrics.router)
 
 if __name__ == '__main__':
+    # Каждый воркер - отдельный процесс, который импортирует приложение заново и в startup создаёт
+    # собственные пулы Redis и клиент ES. uvloop и httptools используются, если они установлены.
+    # По SIGTERM/SIGINT воркеры дорабатывают текущие запросы и выполняют shutdown.
     uvicorn.run(
         'main:app',
-        host='0.0.0.0',
-        port=8000,
+        host=config.API_HOST,
+        port=config.API_PORT,
+        workers=config.API_WORKERS,
+        loop='auto',
+        http='auto',
         log_config=LOGGING,
-        log_level=logging.DEBUG,
+        log_level=config.LOG_LEVEL.lower(),
+        access_log=config.API_ACCESS_LOG,
+        timeout_keep_alive=config.API_KEEP_ALIVE_S,
     )
@@ -14,6 +14,12 @@ class LocalBaseModel(BaseModel):
         json_loads = orjson.loads
         json_dumps = orjson_dumps
 
+    @classmethod
+    def from_es(cls, doc: dict):
+        """Builds the model from an ES document without validation: the index is filled by our ETL
+        from already validated data, so checking it again on every read is wasted CPU."""
+        return cls.construct(**doc['_source'], uuid=doc['_id'])
+
 
 class Genre(LocalBaseModel):
     uuid: UUID
@@ -26,10 +32,34 @@ class FilmForPerson(LocalBaseModel):
     imdb_rating: float
 
 
+class FilmForPersonPage(LocalBaseModel):
+    """Page of a filmography: None in place of the films missing from the movies index, so that items
+    keep their positions within total."""
+    items: List[Optional[FilmForPerson]]
+    total: int
+
+
 class Person(LocalBaseModel):
+    """filmworks is None when it was not requested, films_count is always known."""
     uuid: UUID
     name: str
-    filmworks: Optional[List[FilmForPerson]]
+    filmworks: Optional[List[FilmForPerson]] = None
+    films_count: int = 0
+
+    @classmethod
+    def from_es(cls, doc: dict):
+        source = doc['_source']
+        filmworks = source.get('filmworks')
+        if 'fields' in doc and 'films_count' in doc['fields']:
+            films_count = doc['fields']['films_count'][0]
+        else:
+            films_count = len(filmworks or ())
+        return cls.construct(
+            uuid=doc['_id'],
+            name=source['name'],
+            filmworks=[FilmForPerson.construct(**f) for f in filmworks] if filmworks is not None else None,
+            films_count=films_count,
+        )
 
 
 class PersonShort(LocalBaseModel):
@@ -42,6 +72,36 @@ class GenreShort(LocalBaseModel):
     name: str
 
 
+class FilmShort(LocalBaseModel):
+    uuid: UUID
+    title: str
+    imdb_rating: float
+
+
+class FilmPage(LocalBaseModel):
+    items: List[FilmShort]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+
+
+class GenreFacet(LocalBaseModel):
+    uuid: UUID
+    name: Optional[str]
+    count: int
+
+
+class RatingFacet(LocalBaseModel):
+    min: Optional[float]
+    max: Optional[float]
+    count: int
+
+
+class FilmFacets(LocalBaseModel):
+    total: int
+    genres: List[GenreFacet]
+    imdb_rating: List[RatingFacet]
+
+
 class Film(LocalBaseModel):
     uuid: UUID
     title: str
@@ -56,3 +116,16 @@ class Film(LocalBaseModel):
     actors_names: List[str]
     directors_names: List[str]
     writers_names: List[str]
+
+    @classmethod
+    def from_es(cls, doc: dict):
+        source = dict(doc['_source'])
+        source['genres'] = [GenreShort.construct(**g) for g in source.get('genres') or ()]
+        for role in ('actors', 'writers', 'directors'):
+            source[role] = [PersonShort.construct(**p) for p in source.get(role) or ()]
+        return cls.construct(**source, uuid=doc['_id'])
+
+
+class PersonPage(LocalBaseModel):
+    items: List[Person]
+    next_cursor: Optional[str] = None
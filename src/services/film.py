@@ -1,25 +1,59 @@
 import logging
 import uuid
-from functools import lru_cache
-from typing import Optional
+from typing import AsyncIterator, Optional
 
-from aioredis import Redis
+import orjson
 from elasticsearch import exceptions as es_exceptions
 from fastapi import Depends
 
 from core import config
 from core.exceptions import NotFoundError
-from db.elastic import WrappedAsyncElasticsearch, get_elastic
-from db.redis import get_redis
-from models.film import Film
+from db.elastic import SearchTemplate, WrappedAsyncElasticsearch
+from db.loader import DocumentLoader
+from models.film import Film, FilmFacets, FilmPage, FilmShort, GenreFacet, RatingFacet
+from services.genre import GenreCatalogue
+from services.pagination import InvalidCursorError, get_search_after, next_cursor, with_tiebreaker
+from services.state import RequestContext, get_request_context
+from services.suggest import FilmSuggestIndex, Suggestion
 
 logger = logging.getLogger(__name__)
 
+# Поля, которые нужны спискам фильмов, остальное ES не возвращает
+FILM_SHORT_FIELDS = ['title', 'imdb_rating']
+
+# Список фильмов - самый частый запрос. Он выполняется только в filter-контексте: без подсчёта _score,
+# а при request_cache=true ответы кешируются в shard request cache ES до следующего refresh индекса
+FILM_PAGE_TEMPLATE = SearchTemplate('film_page', '''{
+    "_source": ''' + orjson.dumps(FILM_SHORT_FIELDS).decode() + ''',
+    "query": {"bool": {"filter": [
+        {{#genre_id}}{"term": {"genres_ids": "{{genre_id}}"}}{{/genre_id}}
+    ]}},
+    "sort": {{#toJson}}sort{{/toJson}},
+    "size": {{size}},
+    "from": {{from}},
+    "track_total_hits": true
+    {{#use_search_after}}, "search_after": {{#toJson}}search_after{{/toJson}}{{/use_search_after}}
+}''')
+
+SEARCH_TEMPLATES = [FILM_PAGE_TEMPLATE]
+
+# Фасеты: число жанров в каталоге заведомо меньше, интервалы рейтинга - полуоткрытые [from, to)
+GENRE_FACETS_SIZE = 100
+IMDB_RATING_RANGES = [{'to': 5}, {'from': 5, 'to': 6}, {'from': 6, 'to': 7}, {'from': 7, 'to': 8}, {'from': 8}]
+
 
 class FilmService:
-    def __init__(self, redis: Redis, elastic: WrappedAsyncElasticsearch):
-        self.redis = redis
+    def __init__(
+            self,
+            elastic: WrappedAsyncElasticsearch,
+            genre_catalogue: GenreCatalogue,
+            suggest_index: FilmSuggestIndex,
+            loader: DocumentLoader,
+    ):
         self.elastic = elastic
+        self.genre_catalogue = genre_catalogue
+        self.suggest_index = suggest_index
+        self.loader = loader
 
     async def get_page(
             self,
@@ -27,40 +61,103 @@ class FilmService:
             page_size: int = None,
             sort: str = None,
             genre_id: uuid.UUID = None,
-    ) -> list[Film]:
-        body = {
-            'query': {
-                'bool': {
-                    'must': [
-                        {'match_all': {}}
-                    ]
-                }
-            }
+            cursor: Optional[str] = None,
+    ) -> FilmPage:
+        if genre_id is not None:
+            catalogue = self.genre_catalogue
+            if catalogue.loaded and catalogue.get(genre_id) is None:
+                return FilmPage.construct(items=[], next_cursor=None, total=0)
+
+        sort_spec = [self._get_sorting(sort)] if sort is not None else []
+        if cursor is not None:
+            # Досортировка по уникальному полю нужна только курсорам, обычным страницам она лишь добавляет работы ES
+            sort_spec = with_tiebreaker(sort_spec)
+        params = {
+            'sort': sort_spec,
+            'size': page_size,
+            'from': 0,
         }
-
-        if sort is not None:
-            body['sort'] = self._get_sorting(sort)
-
         if genre_id is not None:
-            body['query']['bool']['filter'] = [{'term': {
-                'genres_ids': genre_id
-            }}]
+            params['genre_id'] = str(genre_id)
+        search_after = get_search_after(cursor, sort_spec)
+        if search_after is not None:
+            params['use_search_after'] = True
+            params['search_after'] = search_after
+        elif cursor is None:
+            params['from'] = (page_number - 1) * page_size
 
         try:
-            resp = await self.elastic.search(
+            resp = await self.elastic.search_template(
                 index=config.ELASTIC_MOVIES_INDEX,
-                body=body,
-                size=page_size,
-                from_=page_number * page_size,
+                body={'id': FILM_PAGE_TEMPLATE.id, 'params': params},
+                params={'request_cache': 'true'},
             )
         except es_exceptions.NotFoundError as e:
             raise NotFoundError
+        except es_exceptions.RequestError:
+            # Значения курсора не подошли к полям сортировки, например курсор изменён вручную
+            if cursor is not None:
+                raise InvalidCursorError(cursor)
+            raise
 
         try:
-            return [Film(uuid=f['_id'], **f['_source']) for f in resp['hits']['hits']]
+            hits = resp['hits']['hits']
+            return FilmPage.construct(
+                items=[FilmShort.from_es(f) for f in hits],
+                next_cursor=next_cursor(hits, sort_spec, page_size) if cursor is not None else None,
+                total=resp['hits'].get('total', {}).get('value'),
+            )
         except KeyError:
             logger.error('Something wrong happened')
-            return []
+            return FilmPage.construct(items=[], next_cursor=None)
+
+    async def get_facets(self, genre_id: uuid.UUID = None) -> FilmFacets:
+        """Total count and per-genre and per-rating-range counts of the films matching the list filter,
+        in one aggregation request."""
+        catalogue = self.genre_catalogue
+        if genre_id is not None and catalogue.loaded and catalogue.get(genre_id) is None:
+            return FilmFacets.construct(total=0, genres=[], imdb_rating=[])
+
+        body = {
+            'query': {'bool': {'filter': [{'term': {'genres_ids': str(genre_id)}}] if genre_id is not None else []}},
+            'track_total_hits': True,
+            'aggs': {
+                'genres': {'terms': {'field': 'genres_ids', 'size': GENRE_FACETS_SIZE}},
+                'imdb_rating': {'range': {'field': 'imdb_rating', 'ranges': IMDB_RATING_RANGES}},
+            },
+        }
+        try:
+            resp = await self.elastic.aggregate(index=config.ELASTIC_MOVIES_INDEX, body=body)
+        except es_exceptions.NotFoundError as e:
+            raise NotFoundError(e.error)
+
+        aggregations = resp['aggregations']
+        genres = []
+        for bucket in aggregations['genres']['buckets']:
+            genre = catalogue.get(bucket['key'])
+            genres.append(GenreFacet.construct(
+                uuid=bucket['key'], name=genre.name if genre else None, count=bucket['doc_count'],
+            ))
+        return FilmFacets.construct(
+            total=resp['hits']['total']['value'],
+            genres=genres,
+            imdb_rating=[
+                RatingFacet.construct(min=bucket.get('from'), max=bucket.get('to'), count=bucket['doc_count'])
+                for bucket in aggregations['imdb_rating']['buckets']
+            ],
+        )
+
+    async def iter_all(self) -> AsyncIterator[Film]:
+        """Every film of the index, read with scroll straight from ES, bypassing the cache."""
+        hits = self.elastic.scan(config.ELASTIC_MOVIES_INDEX, keep_alive=config.EXPORT_SCROLL_KEEP_ALIVE)
+        try:
+            async for hit in hits:
+                yield Film.from_es(hit)
+        finally:
+            await hits.aclose()
+
+    async def suggest(self, prefix: str, limit: int) -> list[Suggestion]:
+        return self.suggest_index.suggest(prefix, limit)
 
     @staticmethod
     def _get_sorting(sort: str) -> dict[str, dict[str, str]]:
@@ -78,11 +175,12 @@ class FilmService:
 
     async def search(
             self, query: str, page_number: int = 1, page_size: int = None
-    ) -> Optional[list[Film]]:
+    ) -> Optional[list[FilmShort]]:
         try:
             resp = await self.elastic.search(
                 index=config.ELASTIC_MOVIES_INDEX,
                 body={
+                    '_source': FILM_SHORT_FIELDS,
                     'query': {
                         'multi_match': {
                             'query': query,
@@ -98,30 +196,34 @@ class FilmService:
                     'sort': {'imdb_rating': {'order': 'desc'}},
                 },
                 size=page_size,
-                from_=page_number * page_size,
+                from_=(page_number - 1) * page_size,
             )
         except es_exceptions.NotFoundError as e:
             raise NotFoundError(e.error)
 
         try:
-            return [Film(uuid=f['_id'], **f['_source']) for f in resp['hits']['hits']]
+            return [FilmShort.from_es(f) for f in resp['hits']['hits']]
         except KeyError:
             logger.error('Something wrong happened')
             return None
 
     async def get_by_id(self, film_id: str) -> Optional[Film]:
         try:
-            doc = await self.elastic.get(config.ELASTIC_MOVIES_INDEX, film_id)
+            doc = await self.loader.load(config.ELASTIC_MOVIES_INDEX, film_id)
         except es_exceptions.NotFoundError as e:
             raise NotFoundError(e.error)
-        
-        film = Film(**doc['_source'], uuid=doc['_id'])
-        return film
-            
-
-@lru_cache()
-def get_film_service(
-        redis: Redis = Depends(get_redis),
-        elastic: WrappedAsyncElasticsearch = Depends(get_elastic),
-) -> FilmService:
-    return FilmService(redis, elastic)
+
+        return Film.from_es(doc) if doc else None
+
+    async def get_many(self, film_ids: list[uuid.UUID]) -> list[Optional[Film]]:
+        try:
+            docs = await self.loader.load_many(config.ELASTIC_MOVIES_INDEX, [str(film_id) for film_id in film_ids])
+        except es_exceptions.NotFoundError as e:
+            raise NotFoundError(e.error)
+
+        return [Film.from_es(doc) if doc else None for doc in docs]
+
+
+async def get_film_service(context: RequestContext = Depends(get_request_context)) -> FilmService:
+    state = context.state
+    return FilmService(state.elastic, state.genre_catalogue, state.film_suggest, context.loader)
@@ -1,43 +1,105 @@
-from functools import lru_cache
-from typing import List, Optional
+import asyncio
+import logging
+import time
+from types import MappingProxyType
+from typing import List, Mapping, Optional
 from uuid import UUID
 
 import elasticsearch
-from aioredis import Redis
 from fastapi import Depends
 
 from core import config
 from core.exceptions import NotFoundError
-from db.elastic import WrappedAsyncElasticsearch, get_elastic
-from db.redis import get_redis
+from db.elastic import WrappedAsyncElasticsearch
 from models.film import Genre
+from services.state import RequestContext, get_request_context
 
+logger = logging.getLogger(__name__)
 
-class GenreService:
-    def __init__(self, redis: Redis, elastic: WrappedAsyncElasticsearch):
-        self.redis = redis
+
+class GenreCatalogue:
+    """The whole genres index kept in memory as an immutable snapshot.
+
+    It is reloaded in the background when the index cache generation changes and at least every
+    GENRE_CATALOGUE_REFRESH_S, so reads never do any I/O.
+    """
+
+    def __init__(self, elastic: WrappedAsyncElasticsearch):
         self.elastic = elastic
+        self.by_id: Mapping[str, Genre] = MappingProxyType({})
+        self.all: tuple[Genre, ...] = ()
+        self.loaded = False
+        self._generation: Optional[int] = None
+        self._loaded_at = 0.0
+        self._load_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, genre_id: UUID) -> Optional[Genre]:
+        return self.by_id.get(str(genre_id))
+
+    async def load(self) -> None:
+        async with self._load_lock:
+            generation = await self.elastic.cache.get_generation(config.ELASTIC_GENRES_INDEX)
+            genres = [
+                Genre(**hit['_source'], uuid=hit['_id'])
+                async for hit in self.elastic.scan(config.ELASTIC_GENRES_INDEX)
+            ]
+            genres.sort(key=lambda genre: genre.name)
+
+            self.by_id = MappingProxyType({str(genre.uuid): genre for genre in genres})
+            self.all = tuple(genres)
+            self.loaded = True
+            self._generation = generation
+            self._loaded_at = time.monotonic()
+        logger.info('Loaded %d genres into memory', len(genres))
+
+    async def ensure_loaded(self) -> None:
+        if not self.loaded:
+            await self.load()
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await asyncio.sleep(config.GENRE_CATALOGUE_CHECK_S)
+            try:
+                generation = await self.elastic.cache.get_generation(config.ELASTIC_GENRES_INDEX)
+                expired = time.monotonic() - self._loaded_at >= config.GENRE_CATALOGUE_REFRESH_S
+                if not self.loaded or expired or generation != self._generation:
+                    await self.load()
+            except Exception:
+                logger.exception('Failed to refresh the genre catalogue')
+
+
+class GenreService:
+    def __init__(self, catalogue: GenreCatalogue):
+        self.catalogue = catalogue
 
     async def get_by_id(self, genre_id: UUID) -> Optional[Genre]:
-        try:
-            doc = await self.elastic.get(config.ELASTIC_GENRES_INDEX, str(genre_id))
-        except elasticsearch.exceptions.NotFoundError as e:
-            raise NotFoundError(e.error)
+        catalogue = await self._get_catalogue()
+        return catalogue.get(genre_id)
 
-        return Genre(**doc['_source'], uuid=doc['_id'])
+    async def get_many(self, genre_ids: List[UUID]) -> List[Optional[Genre]]:
+        catalogue = await self._get_catalogue()
+        return [catalogue.get(genre_id) for genre_id in genre_ids]
 
     async def get_all(self) -> List[Genre]:
+        catalogue = await self._get_catalogue()
+        return list(catalogue.all)
+
+    async def _get_catalogue(self) -> GenreCatalogue:
         try:
-            result = await self.elastic.search(index=config.ELASTIC_GENRES_INDEX, body={"query": {"match_all": {}}})
+            await self.catalogue.ensure_loaded()
         except elasticsearch.exceptions.NotFoundError as e:
             raise NotFoundError(e.error)
-
-        return [Genre(**doc['_source'], uuid=doc['_id']) for doc in result['hits']['hits']]
+        return self.catalogue
 
 
-@lru_cache()
-def get_genre_service(
-        redis: Redis = Depends(get_redis),
-        elastic: WrappedAsyncElasticsearch = Depends(get_elastic),
-) -> GenreService:
-    return GenreService(redis, elastic)
+async def get_genre_service(context: RequestContext = Depends(get_request_context)) -> GenreService:
+    return GenreService(context.state.genre_catalogue)
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aioredis
+import orjson
+
+from core import config
+from db.cache import bypass_cache
+from db.redis import RedisCache
+from services.genre import GenreCatalogue
+from services.suggest import SuggestIndex
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationListener:
+    """Applies the changes published to CACHE_INVALIDATION_CHANNEL to the in-process caches of this worker.
+
+    The publisher (RedisCache.invalidate_docs(), invalidate_cache.py) has already deleted the changed documents
+    from Redis and bumped their versions and the generation of the index, so Redis is consistent even when no worker
+    is listening. A message {"index": "movies", "ids": [...]} makes every worker evict the documents from its local
+    cache, pick up the new versions and generations and update its in-memory catalogues. Without ids the whole index
+    changed, workers pick up the new generation and reload. Messages published while a worker is reconnecting are
+    lost, so after a reconnect it reloads all of its catalogues.
+
+    The publisher should send the message after the ES index refresh, otherwise searches may be recomputed
+    from the old data.
+    """
+
+    def __init__(
+            self,
+            address: tuple[str, int],
+            cache: RedisCache,
+            genre_catalogue: GenreCatalogue,
+            suggest_indices: list[SuggestIndex],
+    ):
+        self.address = address
+        self.cache = cache
+        self.genre_catalogue = genre_catalogue
+        self.suggest_indices = {suggest.index: suggest for suggest in suggest_indices}
+        self._task: Optional[asyncio.Task] = None
+
+    async def handle(self, data: bytes) -> None:
+        message = orjson.loads(data)
+        index = message['index']
+        ids = message.get('ids')
+
+        if ids:
+            await self.cache.evict_docs(index, ids, from_redis=False)
+        self.cache.forget_generations(index)
+        await self._update_catalogues(index, ids)
+        logger.info('Invalidated %s of the %s index', f'{len(ids)} documents' if ids else 'all documents', index)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._listen_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _update_catalogues(self, index: str, ids: Optional[list[str]]) -> None:
+        if index == config.ELASTIC_GENRES_INDEX:
+            # Жанров немного, проще перечитать их все
+            await self.genre_catalogue.load()
+        suggest = self.suggest_indices.get(index)
+        if suggest is not None:
+            await (suggest.refresh_docs(ids) if ids else suggest.load())
+
+    async def _reload_catalogues(self) -> None:
+        for catalogue in (self.genre_catalogue, *self.suggest_indices.values()):
+            try:
+                await catalogue.load()
+            except Exception:
+                logger.exception(
+                    'Failed to reload %s after reconnecting to the invalidation channel', type(catalogue).__name__
+                )
+
+    async def _listen_forever(self) -> None:
+        # Изменённые документы перечитываются из ES, а не из кеша, который другой воркер может ещё не очистить
+        bypass_cache()
+        subscribed = False
+        while True:
+            try:
+                connection = await aioredis.create_redis(self.address)
+                try:
+                    channel, = await connection.subscribe(config.CACHE_INVALIDATION_CHANNEL)
+                    # Пока подписки не было, сообщения могли потеряться. При старте каталоги только что загружены,
+                    # после переподключения их перечитываем, чтобы не ждать планового обновления
+                    self.cache.forget_generations()
+                    if subscribed:
+                        await self._reload_catalogues()
+                    subscribed = True
+                    while await channel.wait_message():
+                        data = await channel.get()
+                        try:
+                            await self.handle(data)
+                        except Exception:
+                            logger.exception('Failed to apply cache invalidation %r', data)
+                finally:
+                    connection.close()
+                    await connection.wait_closed()
+            except Exception:
+                logger.exception('Cache invalidation channel is unavailable')
+            await asyncio.sleep(config.CACHE_INVALIDATION_RECONNECT_S)
@@ -0,0 +1,61 @@
+import base64
+import binascii
+from hashlib import sha1
+from typing import Any, Optional
+
+import orjson
+
+from core import config
+
+# Значение page[cursor] для первой страницы курсорного обхода
+CURSOR_START = 'start'
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def _sort_fingerprint(sort: list[dict]) -> str:
+    return sha1(orjson.dumps(sort, option=orjson.OPT_SORT_KEYS)).hexdigest()[:12]
+
+
+def encode_cursor(sort: list[dict], sort_values: list[Any]) -> str:
+    """The cursor carries a fingerprint of the sort it was issued for, so that it is never passed to search_after
+    of a query with another sort."""
+    cursor = {'s': _sort_fingerprint(sort), 'v': sort_values}
+    return base64.urlsafe_b64encode(orjson.dumps(cursor)).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: list[dict]) -> list[Any]:
+    """search_after values of a cursor issued for the same sort, InvalidCursorError for any other cursor."""
+    try:
+        decoded = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise InvalidCursorError(cursor)
+
+    if not isinstance(decoded, dict) or decoded.get('s') != _sort_fingerprint(sort):
+        raise InvalidCursorError(cursor)
+    sort_values = decoded.get('v')
+    if not isinstance(sort_values, list) or len(sort_values) != len(sort):
+        raise InvalidCursorError(cursor)
+    if not all(value is None or isinstance(value, (str, int, float)) for value in sort_values):
+        raise InvalidCursorError(cursor)
+    return sort_values
+
+
+def get_search_after(cursor: Optional[str], sort: list[dict]) -> Optional[list[Any]]:
+    """search_after of the page the cursor points to, None for the first page and for offset pagination."""
+    if cursor is None or cursor == CURSOR_START:
+        return None
+    return decode_cursor(cursor, sort)
+
+
+def with_tiebreaker(sort: list[dict]) -> list[dict]:
+    """Appends a unique field to the sort so that search_after never skips or repeats documents."""
+    return sort + [{config.ELASTIC_TIEBREAKER_FIELD: {'order': 'asc'}}]
+
+
+def next_cursor(hits: list[dict], sort: list[dict], page_size: int) -> Optional[str]:
+    if len(hits) < page_size or 'sort' not in hits[-1]:
+        return None
+    return encode_cursor(sort, hits[-1]['sort'])
@@ -1,68 +1,133 @@
-from functools import lru_cache
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 from uuid import UUID
 
 import elasticsearch
-from aioredis import Redis
 from fastapi import Depends
 
 from core import config
 from core.exceptions import NotFoundError
-from db.elastic import WrappedAsyncElasticsearch, get_elastic
-from db.redis import get_redis
-from models.film import FilmForPerson, Person
+from db.elastic import WrappedAsyncElasticsearch
+from db.loader import DocumentLoader
+from models.film import FilmForPerson, FilmForPersonPage, Person, PersonPage
+from services.film import FILM_SHORT_FIELDS
+from services.pagination import InvalidCursorError, get_search_after, next_cursor, with_tiebreaker
+from services.state import RequestContext, get_request_context
+from services.suggest import PersonSuggestIndex, Suggestion
+
+# Для страниц фильмографии персона читается без самой фильмографии, только компактный список id фильмов.
+# Страницы собираются из кешированных коротких документов фильмов
+FILMOGRAPHY_SOURCE = ['filmworks.uid']
+
+# В поиске от фильмографии остаётся только число фильмов
+PERSON_SEARCH_SOURCE = ['name']
+FILMS_COUNT_SCRIPT = "params['_source']['filmworks'] == null ? 0 : params['_source']['filmworks'].size()"
 
 
 class PersonService:
-    def __init__(self, redis: Redis, elastic: WrappedAsyncElasticsearch):
-        self.redis = redis
+    def __init__(self, elastic: WrappedAsyncElasticsearch, suggest_index: PersonSuggestIndex, loader: DocumentLoader):
         self.elastic = elastic
+        self.suggest_index = suggest_index
+        self.loader = loader
 
     async def get_by_id(self, person_id: UUID) -> Optional[Person]:
         return await self._get_person_from_elastic(person_id)
 
-    async def get_films_for_person(self, person_id: UUID) -> List[FilmForPerson]:
-        person = await self._get_person_from_elastic(person_id)
-        return person.filmworks if person else None
+    async def get_many(self, person_ids: List[UUID]) -> List[Optional[Person]]:
+        try:
+            docs = await self.loader.load_many(
+                config.ELASTIC_PERSONS_INDEX, [str(person_id) for person_id in person_ids]
+            )
+        except elasticsearch.exceptions.NotFoundError as e:
+            raise NotFoundError(e.error)
+
+        return [Person.from_es(doc) if doc else None for doc in docs]
 
-    async def search_persons(self, query: str, page_number: int, page_size: int) -> List[Person]:
-        size = page_size
-        offset = (page_number - 1) * page_size
+    async def get_films_for_person(
+            self, person_id: UUID, page_number: int, page_size: int
+    ) -> Optional[FilmForPersonPage]:
         try:
-            result = await self.elastic.search(
-                index=config.ELASTIC_PERSONS_INDEX,
-                body={
-                    "from": offset,
-                    "size": size,
-                    "query": {
-                        "multi_match": {
-                            "query": query,
-                            "fuzziness": "auto",
-                            "fields": [
-                                "name"
-                            ]
-                        }
-                    }
+            doc = await self.loader.load(config.ELASTIC_PERSONS_INDEX, str(person_id), source=FILMOGRAPHY_SOURCE)
+        except elasticsearch.exceptions.NotFoundError as e:
+            raise NotFoundError(e.error)
+        if not doc:
+            return None
+
+        film_ids = [filmwork['uid'] for filmwork in doc['_source'].get('filmworks') or ()]
+        offset = (page_number - 1) * page_size
+        docs = await self.loader.load_many(
+            config.ELASTIC_MOVIES_INDEX, film_ids[offset:offset + page_size], source=FILM_SHORT_FIELDS
+        )
+        films = [
+            FilmForPerson.construct(
+                uid=doc['_id'], title=doc['_source']['title'], imdb_rating=doc['_source'].get('imdb_rating')
+            ) if doc else None
+            for doc in docs
+        ]
+        return FilmForPersonPage.construct(items=films, total=len(film_ids))
+
+    async def search_persons(
+            self, query: str, page_number: int, page_size: int, cursor: Optional[str] = None
+    ) -> PersonPage:
+        sort = [{"_score": {"order": "desc"}}]
+        if cursor is not None:
+            sort = with_tiebreaker(sort)
+        body = {
+            "_source": PERSON_SEARCH_SOURCE,
+            "script_fields": {"films_count": {"script": {"source": FILMS_COUNT_SCRIPT}}},
+            "size": page_size,
+            "query": {
+                "multi_match": {
+                    "query": query,
+                    "fuzziness": "auto",
+                    "fields": [
+                        "name"
+                    ]
                 }
-            )
+            },
+            "sort": sort,
+        }
+        search_after = get_search_after(cursor, sort)
+        if search_after is not None:
+            body["search_after"] = search_after
+        elif cursor is None:
+            body["from"] = (page_number - 1) * page_size
+
+        try:
+            result = await self.elastic.search(index=config.ELASTIC_PERSONS_INDEX, body=body)
         except elasticsearch.exceptions.NotFoundError as e:
             raise NotFoundError(e.error)
+        except elasticsearch.exceptions.RequestError:
+            # Значения курсора не подошли к полям сортировки, например курсор изменён вручную
+            if cursor is not None:
+                raise InvalidCursorError(cursor)
+            raise
+
+        hits = result['hits']['hits']
+        persons = [Person.from_es(item) for item in hits]
+        return PersonPage.construct(
+            items=persons, next_cursor=next_cursor(hits, sort, page_size) if cursor is not None else None
+        )
+
+    async def iter_all(self) -> AsyncIterator[Person]:
+        """Every person of the index, read with scroll straight from ES, bypassing the cache."""
+        hits = self.elastic.scan(config.ELASTIC_PERSONS_INDEX, keep_alive=config.EXPORT_SCROLL_KEEP_ALIVE)
+        try:
+            async for hit in hits:
+                yield Person.from_es(hit)
+        finally:
+            await hits.aclose()
 
-        persons = [Person(**item['_source'], uuid=item['_id']) for item in result['hits']['hits']]
-        return persons
+    async def suggest(self, prefix: str, limit: int) -> list[Suggestion]:
+        return self.suggest_index.suggest(prefix, limit)
 
     async def _get_person_from_elastic(self, person_id: UUID) -> Optional[Person]:
         try:
-            doc = await self.elastic.get(config.ELASTIC_PERSONS_INDEX, str(person_id))
+            doc = await self.loader.load(config.ELASTIC_PERSONS_INDEX, str(person_id))
         except elasticsearch.exceptions.NotFoundError as e:
             raise NotFoundError(e.error)
 
-        return Person(**doc['_source'], uuid=doc['_id'])
+        return Person.from_es(doc) if doc else None
 
 
-@lru_cache()
-def get_person_service(
-        redis: Redis = Depends(get_redis),
-        elastic: WrappedAsyncElasticsearch = Depends(get_elastic),
-) -> PersonService:
-    return PersonService(redis, elastic)
+async def get_person_service(context: RequestContext = Depends(get_request_context)) -> PersonService:
+    return PersonService(context.state.elastic, context.state.person_suggest, context.loader)
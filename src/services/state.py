@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Optional
+
+from fastapi import Request
+
+from db.elastic import WrappedAsyncElasticsearch
+from db.loader import DocumentLoader
+from db.redis import RedisCache
+
+if TYPE_CHECKING:
+    from services.genre import GenreCatalogue
+    from services.invalidation import InvalidationListener
+    from services.suggest import FilmSuggestIndex, PersonSuggestIndex
+    from services.warmup import CacheWarmer
+
+logger = logging.getLogger(__name__)
+
+
+class AppState:
+    """Singletons shared by every request of one application, kept in app.state.services.
+
+    It is built by main.startup from the real clients and by benchmarks/load_test.py from the fakes, services
+    get everything from here instead of module globals. The cache and the ES overload protection (elastic.limiter,
+    elastic.breaker) are per application too, only the metric counters are process-wide.
+    """
+
+    def __init__(
+            self,
+            cache: RedisCache,
+            elastic: WrappedAsyncElasticsearch,
+            genre_catalogue: 'GenreCatalogue',
+            film_suggest: 'FilmSuggestIndex',
+            person_suggest: 'PersonSuggestIndex',
+    ):
+        self.cache = cache
+        self.elastic = elastic
+        self.genre_catalogue = genre_catalogue
+        self.film_suggest = film_suggest
+        self.person_suggest = person_suggest
+        self.warmer: Optional['CacheWarmer'] = None
+        self.invalidation_listener: Optional['InvalidationListener'] = None
+
+    async def load(self) -> None:
+        """Fills the in-memory catalogues, the ones that fail are retried by their background refresh."""
+        try:
+            await self.genre_catalogue.load()
+        except Exception:
+            logger.exception('Genre catalogue is not loaded, it will be retried in the background')
+        for index in (self.film_suggest, self.person_suggest):
+            try:
+                await index.load()
+            except Exception:
+                logger.exception('Suggest index of %s is not built, it will be retried in the background', index.index)
+
+    def start(self) -> None:
+        self.genre_catalogue.start()
+        self.film_suggest.start()
+        self.person_suggest.start()
+        if self.invalidation_listener is not None:
+            self.invalidation_listener.start()
+        if self.warmer is not None:
+            self.warmer.start()
+
+    async def stop(self) -> None:
+        if self.invalidation_listener is not None:
+            await self.invalidation_listener.stop()
+        if self.warmer is not None:
+            await self.warmer.stop()
+            await self.warmer.flush()
+        await asyncio.gather(self.genre_catalogue.stop(), self.film_suggest.stop(), self.person_suggest.stop())
+
+
+class RequestContext:
+    """State of one request shared by all the services it uses."""
+
+    def __init__(self, state: AppState):
+        self.state = state
+        self.loader = DocumentLoader(state.elastic)
+
+
+def get_app_state(request: Request) -> AppState:
+    return request.app.state.services
+
+
+async def get_request_context(request: Request) -> RequestContext:
+    """FastAPI caches dependencies within a request, so every service of the request gets the same context."""
+    return RequestContext(get_app_state(request))
@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Iterable, NamedTuple, Optional
+
+from core import config
+from db.elastic import WrappedAsyncElasticsearch
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+
+# Подсказки для таких коротких префиксов вычисляются заранее, иначе под них попадает большая часть индекса
+_PRECOMPUTED_PREFIX_LENGTH = 2
+
+# Не индексируем суффиксы названия дальше этого слова, чтобы длинные названия не раздували индекс
+_MAX_WORDS = 8
+
+
+class Suggestion(NamedTuple):
+    uuid: str
+    text: str
+    rating: float
+
+
+def normalize(text: str) -> str:
+    return ' '.join(_WORD_RE.findall(text.casefold()))
+
+
+def _terms(text: str) -> list[str]:
+    """Every word-start suffix of the text, so that a prefix matches the beginning of any word:
+    'the dark knight' -> 'the dark knight', 'dark knight', 'knight'."""
+    words = normalize(text).split()
+    return [' '.join(words[i:]) for i in range(min(len(words), _MAX_WORDS))]
+
+
+def _rating(suggestion: Suggestion) -> float:
+    return suggestion.rating
+
+
+class PrefixIndex:
+    """Immutable sorted array of (term, document) pairs, a prefix is looked up with two bisections."""
+
+    def __init__(self, suggestions: Iterable[Suggestion]):
+        pairs = sorted((term, s) for s in suggestions for term in _terms(s.text))
+        self.terms = [term for term, _ in pairs]
+        self.suggestions = [s for _, s in pairs]
+
+        top: dict[str, dict[str, Suggestion]] = {}
+        for term, suggestion in pairs:
+            for length in range(1, min(len(term), _PRECOMPUTED_PREFIX_LENGTH) + 1):
+                top.setdefault(term[:length], {})[suggestion.uuid] = suggestion
+        self._top = {
+            prefix: heapq.nlargest(config.SUGGEST_MAX_LIMIT, found.values(), key=_rating)
+            for prefix, found in top.items()
+        }
+
+    def __len__(self) -> int:
+        return len({s.uuid for s in self.suggestions})
+
+    def candidates(self, prefix: str) -> Iterable[Suggestion]:
+        if len(prefix) <= _PRECOMPUTED_PREFIX_LENGTH:
+            return self._top.get(prefix, ())
+        lo = bisect_left(self.terms, prefix)
+        hi = bisect_left(self.terms, prefix + '\uffff', lo)
+        return {s.uuid: s for s in self.suggestions[lo:hi]}.values()
+
+
+class SuggestIndex(ABC):
+    """In-memory prefix index of one ES index for typeahead, top-k by rating.
+
+    The base PrefixIndex is rebuilt from a full scan when the index cache generation changes and at least every
+    SUGGEST_INDEX_REFRESH_S. Single documents are changed in between with upsert()/remove(): they go to a small
+    overlay that is searched linearly and merged into the base index once it grows past SUGGEST_OVERLAY_MAX_SIZE.
+    """
+
+    # Задаются в наследниках: индекс ES и поля документа, нужные to_suggestion()
+    index: str
+    source: list[str]
+
+    def __init__(self, elastic: WrappedAsyncElasticsearch):
+        self.elastic = elastic
+        self.base = PrefixIndex(())
+        self.loaded = False
+        self._overlay: dict[str, Optional[Suggestion]] = {}
+        self._generation: Optional[int] = None
+        self._loaded_at = 0.0
+        self._load_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    def to_suggestion(self, doc_id: str, source: dict) -> Suggestion:
+        """Suggestion of a document read with the `source` fields."""
+
+    def suggest(self, prefix: str, limit: int) -> list[Suggestion]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        found = [s for s in self.base.candidates(prefix) if s.uuid not in self._overlay]
+        for suggestion in self._overlay.values():
+            if suggestion is not None and any(term.startswith(prefix) for term in _terms(suggestion.text)):
+                found.append(suggestion)
+        return heapq.nlargest(limit, found, key=_rating)
+
+    def upsert(self, doc_id: str, source: dict) -> None:
+        self._overlay[doc_id] = self.to_suggestion(doc_id, source)
+        self._compact_if_needed()
+
+    def remove(self, doc_id: str) -> None:
+        self._overlay[doc_id] = None
+        self._compact_if_needed()
+
+    async def refresh_docs(self, ids: list[str]) -> None:
+        """Re-reads changed documents, the ones that no longer exist are removed."""
+        docs = await self.elastic.mget_by_ids(self.index, ids, source=self.source)
+        for doc_id, doc in zip(ids, docs):
+            if doc is None:
+                self.remove(doc_id)
+            else:
+                self.upsert(doc_id, doc['_source'])
+
+    async def load(self) -> None:
+        async with self._load_lock:
+            generation = await self.elastic.cache.get_generation(self.index)
+            suggestions = [
+                self.to_suggestion(hit['_id'], hit['_source'])
+                async for hit in self.elastic.scan(self.index, source=self.source)
+            ]
+            self.base = PrefixIndex(suggestions)
+            self._overlay = {}
+            self.loaded = True
+            self._generation = generation
+            self._loaded_at = time.monotonic()
+        logger.info('Built suggest index of %d %s documents', len(suggestions), self.index)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _compact_if_needed(self) -> None:
+        if len(self._overlay) < config.SUGGEST_OVERLAY_MAX_SIZE:
+            return
+        merged = {s.uuid: s for s in self.base.suggestions}
+        for doc_id, suggestion in self._overlay.items():
+            if suggestion is None:
+                merged.pop(doc_id, None)
+            else:
+                merged[doc_id] = suggestion
+        self.base = PrefixIndex(merged.values())
+        self._overlay = {}
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await asyncio.sleep(config.SUGGEST_INDEX_CHECK_S)
+            try:
+                generation = await self.elastic.cache.get_generation(self.index)
+                expired = time.monotonic() - self._loaded_at >= config.SUGGEST_INDEX_REFRESH_S
+                if not self.loaded or expired or generation != self._generation:
+                    await self.load()
+            except Exception:
+                logger.exception('Failed to refresh the %s suggest index', self.index)
+
+
+class FilmSuggestIndex(SuggestIndex):
+    index = config.ELASTIC_MOVIES_INDEX
+    source = ['title', 'imdb_rating']
+
+    def to_suggestion(self, doc_id: str, source: dict) -> Suggestion:
+        return Suggestion(doc_id, source['title'], source.get('imdb_rating') or 0.0)
+
+
+class PersonSuggestIndex(SuggestIndex):
+    """Persons are ranked by the best imdb_rating among their films."""
+
+    index = config.ELASTIC_PERSONS_INDEX
+    source = ['name', 'filmworks.imdb_rating']
+
+    def to_suggestion(self, doc_id: str, source: dict) -> Suggestion:
+        ratings = [f.get('imdb_rating') or 0.0 for f in source.get('filmworks') or ()]
+        return Suggestion(doc_id, source['name'], max(ratings, default=0.0))
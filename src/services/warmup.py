@@ -0,0 +1,224 @@
+import asyncio
+import heapq
+import logging
+import time
+from operator import itemgetter
+from typing import Optional
+from urllib.parse import urlencode
+
+from aioredis import Redis
+from starlette.types import ASGIApp
+
+from core import config
+from core.limiter import Priority, set_priority
+from db.cache import bypass_cache
+from services.genre import GenreCatalogue
+
+logger = logging.getLogger(__name__)
+
+# Общий для воркеров рейтинг запросов: member - путь с нормализованными параметрами, score - число запросов
+HOT_KEYS_KEY = 'warmup:hot_keys'
+# Живёт CACHE_WARMUP_INTERVAL_S: пока ключ есть, прогрев уже сделан другим воркером. После очистки Redis
+# ключа нет, поэтому прогрев начинается сразу
+LOCK_KEY = 'warmup:lock'
+
+# Рейтинг хранит больше ключей, чем прогревается, чтобы новые запросы успевали набрать счётчик
+_TRACKED_KEYS_FACTOR = 10
+
+# Варианты сортировки списка фильмов, которые прогреваются, пока рейтинг пуст
+_SEED_SORTS = (None, 'imdb_rating', '-imdb_rating', 'title', '-title')
+
+
+class SpaceSaving:
+    """Space-saving heavy hitters sketch: at most `capacity` keys are counted, a new key replaces the least
+    counted one and inherits its count. Every key seen more than total / capacity times is kept, counts are
+    overestimated by at most the inherited count."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        # Минимальная куча (count, key); счётчики в ней могут отставать, они исправляются при вытеснении
+        self._heap: list[tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, key: str) -> None:
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts[key] = count + 1
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[key] = 1
+            heapq.heappush(self._heap, (1, key))
+            return
+
+        while True:
+            count, victim = heapq.heappop(self._heap)
+            actual = self.counts[victim]
+            if actual == count:
+                break
+            heapq.heappush(self._heap, (actual, victim))
+        del self.counts[victim]
+        self.counts[key] = count + 1
+        heapq.heappush(self._heap, (count + 1, key))
+
+    def top(self, n: Optional[int] = None) -> list[tuple[str, int]]:
+        if n is None:
+            return sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def clear(self) -> None:
+        self.counts.clear()
+        self._heap.clear()
+
+
+def request_key(path: str, params: list[tuple[str, str]]) -> str:
+    return f'{path}?{urlencode(params)}' if params else path
+
+
+class CacheWarmer:
+    """Keeps the most requested film list and search responses in the cache.
+
+    Every worker counts its requests in a SpaceSaving sketch and periodically adds the counts to a shared
+    Redis sorted set. Every CACHE_WARMUP_INTERVAL_S, a little less than the cache TTL, one worker replays the top
+    requests through the application with the cache bypassed, so their entries are rewritten before they expire.
+    Replays go at low ES priority and at most CACHE_WARMUP_CONCURRENCY at once.
+    """
+
+    def __init__(self, app: ASGIApp, redis: Redis, genre_catalogue: GenreCatalogue):
+        self.app = app
+        self.redis = redis
+        self.genre_catalogue = genre_catalogue
+        self.sketch = SpaceSaving(config.CACHE_WARMUP_SKETCH_SIZE)
+        self._paths = {path.rstrip('/'): path for path in config.CACHE_WARMUP_PATHS}
+        self._tasks: list[asyncio.Task] = []
+
+    def record(self, path: str, params: list[tuple[str, str]]) -> None:
+        canonical = self._paths.get(path.rstrip('/'))
+        if canonical is not None:
+            self.sketch.add(request_key(canonical, params))
+
+    async def flush(self) -> None:
+        """Adds the counts of this worker to the shared ranking."""
+        counts = self.sketch.top()
+        self.sketch.clear()
+        if not counts:
+            return
+        pipeline = self.redis.pipeline()
+        for key, count in counts:
+            pipeline.zincrby(HOT_KEYS_KEY, count, key)
+        await pipeline.execute()
+
+    async def hot_keys(self) -> list[str]:
+        keys = await self.redis.zrevrange(HOT_KEYS_KEY, 0, config.CACHE_WARMUP_TOP_KEYS - 1, encoding='utf-8')
+        return keys or self.seed_keys()
+
+    def seed_keys(self) -> list[str]:
+        """First pages of the film list for every sort and genre, for when nothing has been counted yet,
+        e.g. right after Redis was flushed."""
+        genres = [None] + [str(genre.uuid) for genre in self.genre_catalogue.all]
+        path = config.CACHE_WARMUP_PATHS[0]
+        keys = []
+        for genre in genres:
+            for sort in _SEED_SORTS:
+                params = [('sort', sort)] if sort else []
+                if genre:
+                    params.append(('filter[genre]', genre))
+                keys.append(request_key(path, params))
+        return keys
+
+    async def warm(self, keys: list[str]) -> int:
+        """Replays the requests, returns how many of them succeeded."""
+        semaphore = asyncio.Semaphore(config.CACHE_WARMUP_CONCURRENCY)
+
+        async def replay(key: str) -> bool:
+            async with semaphore:
+                try:
+                    return await self._replay(key) == 200
+                except Exception:
+                    logger.exception('Failed to warm up %s', key)
+                    return False
+
+        started = time.monotonic()
+        results = await asyncio.gather(*[replay(key) for key in keys])
+        logger.info(
+            'Warmed up %d of %d requests in %.2f s', sum(results), len(keys), time.monotonic() - started,
+        )
+        return sum(results)
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._flush_forever()),
+            asyncio.ensure_future(self._warm_forever()),
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _replay(self, key: str) -> int:
+        path, _, query = key.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': [(b'host', b'cache-warmup')],
+            'client': None,
+            'server': None,
+        }
+        received = False
+        status = 0
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await self.app(scope, receive, send)
+        return status
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(config.CACHE_WARMUP_FLUSH_S)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush request counts for the cache warm-up')
+
+    async def _warm_forever(self) -> None:
+        # Контекст задачи наследуют все повторяемые запросы
+        bypass_cache()
+        set_priority(Priority.LOW)
+        while True:
+            try:
+                acquired = await self.redis.set(
+                    LOCK_KEY, b'1', expire=config.CACHE_WARMUP_INTERVAL_S, exist=Redis.SET_IF_NOT_EXIST,
+                )
+                if acquired:
+                    await self.warm(await self.hot_keys())
+                    await self._decay()
+            except Exception:
+                logger.exception('Failed to warm up the cache')
+            await asyncio.sleep(config.CACHE_WARMUP_CHECK_S)
+
+    async def _decay(self) -> None:
+        await self.redis.zunionstore(HOT_KEYS_KEY, (HOT_KEYS_KEY, config.CACHE_WARMUP_DECAY), with_weights=True)
+        await self.redis.zremrangebyrank(
+            HOT_KEYS_KEY, 0, -config.CACHE_WARMUP_TOP_KEYS * _TRACKED_KEYS_FACTOR - 1,
+        )
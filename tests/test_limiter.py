@@ -0,0 +1,217 @@
+"""State transitions of the ES overload protection: AdaptiveLimiter, CircuitBreaker and their use in _guarded().
+
+    python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from core.exceptions import ServiceUnavailableError  # noqa: E402
+from core.limiter import AdaptiveLimiter, CircuitBreaker, Priority  # noqa: E402
+from db.elastic import WrappedAsyncElasticsearch  # noqa: E402
+
+
+def make_limiter(**kwargs) -> AdaptiveLimiter:
+    params = dict(
+        initial=2, min_limit=1, max_limit=10, latency_target_s=0.1, backoff=0.5,
+        queue_size=4, queue_timeout_s=0.05, retry_after_s=1,
+    )
+    params.update(kwargs)
+    return AdaptiveLimiter('test', **params)
+
+
+class AdaptiveLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_acquires_up_to_the_limit_without_waiting(self):
+        limiter = make_limiter()
+        await limiter.acquire(Priority.NORMAL)
+        await limiter.acquire(Priority.NORMAL)
+        self.assertEqual(limiter.in_flight, 2)
+        self.assertEqual(limiter.queued, 0)
+
+    async def test_release_wakes_the_highest_priority_first(self):
+        limiter = make_limiter(initial=1, max_limit=1, queue_timeout_s=1)
+        await limiter.acquire(Priority.NORMAL)
+        order = []
+
+        async def wait(priority: Priority):
+            await limiter.acquire(priority)
+            order.append(priority)
+
+        low = asyncio.ensure_future(wait(Priority.LOW))
+        high = asyncio.ensure_future(wait(Priority.HIGH))
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.queued, 2)
+
+        limiter.release(0.01)
+        await asyncio.sleep(0.01)
+        self.assertEqual(order, [Priority.HIGH])
+        limiter.release(0.01)
+        await asyncio.gather(low, high)
+        self.assertEqual(order, [Priority.HIGH, Priority.LOW])
+
+    async def test_rejects_when_the_share_of_the_queue_is_full(self):
+        limiter = make_limiter(initial=1, queue_size=4, queue_timeout_s=1)
+        await limiter.acquire(Priority.NORMAL)
+        # LOW может занять четверть очереди, то есть одно место
+        waiting = asyncio.ensure_future(limiter.acquire(Priority.LOW))
+        await asyncio.sleep(0)
+        with self.assertRaises(ServiceUnavailableError):
+            await limiter.acquire(Priority.LOW)
+        # HIGH доступна вся очередь
+        high = asyncio.ensure_future(limiter.acquire(Priority.HIGH))
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.queued, 2)
+        for task in (waiting, high):
+            task.cancel()
+        await asyncio.gather(waiting, high, return_exceptions=True)
+
+    async def test_rejects_after_the_queue_timeout(self):
+        limiter = make_limiter(initial=1)
+        await limiter.acquire(Priority.NORMAL)
+        with self.assertRaises(ServiceUnavailableError):
+            await limiter.acquire(Priority.NORMAL)
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertEqual(limiter.queued, 0)
+
+    async def test_admitted_work_waits_without_timeout_or_queue_limit(self):
+        limiter = make_limiter(initial=1, queue_size=0)
+        await limiter.acquire(Priority.NORMAL)
+        waiting = asyncio.ensure_future(limiter.acquire(Priority.LOW, reject=False))
+        await asyncio.sleep(limiter.queue_timeout_s * 2)
+        self.assertFalse(waiting.done())
+        limiter.release(0.01)
+        await waiting
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_cancelled_waiter_does_not_keep_a_slot(self):
+        limiter = make_limiter(initial=1, queue_timeout_s=1)
+        await limiter.acquire(Priority.NORMAL)
+        waiting = asyncio.ensure_future(limiter.acquire(Priority.NORMAL))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        limiter.release(0.01)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.queued, 0)
+
+    async def test_limit_grows_at_the_limit_and_backs_off_on_slow_calls(self):
+        limiter = make_limiter(initial=2)
+        await limiter.acquire(Priority.NORMAL)
+        await limiter.acquire(Priority.NORMAL)
+        limiter.release(0.01)
+        self.assertAlmostEqual(limiter.limit, 2.5)
+
+        limiter.release(1.0)
+        self.assertAlmostEqual(limiter.limit, 1.25)
+        # Второй медленный вызов в пределах latency_target_s - тот же сигнал перегрузки
+        await limiter.acquire(Priority.NORMAL)
+        limiter.release(1.0, overloaded=True)
+        self.assertAlmostEqual(limiter.limit, 1.25)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', failures=2, reset_s=10)
+
+    def open(self):
+        for _ in range(self.breaker.failures):
+            self.assertFalse(self.breaker.check())
+            self.breaker.failure()
+        self.assertTrue(self.breaker.is_open)
+
+    def half_open(self):
+        self.open()
+        self.breaker.opened_at = time.monotonic() - self.breaker.reset_s
+
+    def test_opens_after_consecutive_failures_only(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.failure()
+        self.assertTrue(self.breaker.is_open)
+
+    def test_rejects_while_open(self):
+        self.open()
+        with self.assertRaises(ServiceUnavailableError):
+            self.breaker.check()
+
+    def test_lets_a_single_probe_through_when_half_open(self):
+        self.half_open()
+        self.assertTrue(self.breaker.check())
+        with self.assertRaises(ServiceUnavailableError):
+            self.breaker.check()
+
+    def test_successful_probe_closes(self):
+        self.half_open()
+        self.breaker.check()
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertFalse(self.breaker.check())
+
+    def test_failed_probe_opens_again(self):
+        self.half_open()
+        self.breaker.check()
+        self.breaker.failure()
+        with self.assertRaises(ServiceUnavailableError):
+            self.breaker.check()
+
+    def test_abandoned_probe_lets_the_next_one_through(self):
+        self.half_open()
+        self.breaker.check()
+        self.breaker.abandon()
+        self.assertTrue(self.breaker.check())
+
+
+class GuardedTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.elastic = WrappedAsyncElasticsearch(
+            hosts=['localhost:9200'],
+            cache=mock.Mock(),
+            limiter=make_limiter(initial=1),
+            breaker=CircuitBreaker('test', failures=1, reset_s=10),
+        )
+
+    async def asyncTearDown(self):
+        await self.elastic.close()
+
+    def half_open(self):
+        self.elastic.breaker.failure()
+        self.elastic.breaker.opened_at = time.monotonic() - self.elastic.breaker.reset_s
+
+    async def test_probe_rejected_by_the_limiter_does_not_stick(self):
+        self.half_open()
+        await self.elastic.limiter.acquire(Priority.NORMAL)
+        with self.assertRaises(ServiceUnavailableError):
+            async with self.elastic._guarded('search', 'movies'):
+                pass
+        self.elastic.limiter.release(0.01)
+
+        async with self.elastic._guarded('search', 'movies'):
+            pass
+        self.assertFalse(self.elastic.breaker.is_open)
+
+    async def test_probe_cancelled_in_the_queue_does_not_stick(self):
+        self.half_open()
+        await self.elastic.limiter.acquire(Priority.NORMAL)
+
+        async def call():
+            async with self.elastic._guarded('search', 'movies'):
+                pass
+
+        task = asyncio.ensure_future(call())
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.elastic.limiter.release(0.01)
+
+        self.assertTrue(self.elastic.breaker.check())
+
+
+if __name__ == '__main__':
+    unittest.main()